@@ -0,0 +1,74 @@
+"""
+    Benchmarks for serializing deferred tasks.
+
+    `test_serialize_task` measures a typical task (with the default compression).
+    `test_serialize_deepcopy` reproduces how defer() used to wipe related
+    caches (deep-copying each instance) for comparison with the pickler.
+"""
+import copy
+import pickle
+
+from django.db import models
+
+from djangae.tasks.deferred import (
+    _curry_callable,
+    _dumps,
+    _serialize,
+)
+
+
+class BenchRelated(models.Model):
+    class Meta:
+        app_label = "djangae"
+
+
+class BenchInstance(models.Model):
+    related = models.ForeignKey(BenchRelated, on_delete=models.CASCADE)
+    data = models.JSONField(default=dict)
+
+    class Meta:
+        app_label = "djangae"
+
+
+def _task(*args, **kwargs):
+    pass
+
+
+def _make_instances(count=10):
+    instances = []
+    for i in range(count):
+        related = BenchRelated(pk=i + 1)
+        instance = BenchInstance(pk=i + 1, related=related)
+        instance.data = {"values": list(range(5000)), "nested": [{"key": str(x)} for x in range(500)]}
+        instances.append(instance)
+    return instances
+
+
+def _deepcopy_and_pickle(args):
+    args = list(args)
+    for i, arg in enumerate(args):
+        if isinstance(arg, models.Model):
+            args[i] = copy.deepcopy(arg)
+            for field in (f for f in args[i]._meta.fields if f.remote_field):
+                if field.is_cached(args[i]):
+                    field.delete_cached_value(args[i])
+
+    return pickle.dumps(_curry_callable(_task, *args), protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def test_serialize_deepcopy(benchmark):
+    instances = _make_instances()
+    benchmark(_deepcopy_and_pickle, instances)
+
+
+def test_serialize_pickler(benchmark, settings):
+    # Compare like with like
+    settings.DJANGAE_DEFERRED_COMPRESSION = None
+
+    instances = _make_instances()
+    benchmark(_dumps, _curry_callable(_task, *instances), wipe_related_caches=True)
+
+
+def test_serialize_task(benchmark):
+    instance = _make_instances(1)[0]
+    benchmark(_serialize, _task, instance.pk, data=instance.data, related_ids=list(range(100)))
@@ -0,0 +1,35 @@
+"""
+    Benchmarks for acquiring and releasing cache based (weak) locks.
+
+    These use the local memory cache from the test settings, so they measure the
+    lock's own overhead rather than the round trip to memcache.
+"""
+from django.core.cache import cache
+
+from djangae.contrib.locking.memcache import MemcacheLock
+
+
+def test_memcache_lock_acquire_release(benchmark):
+    cache.clear()
+
+    def acquire_release():
+        MemcacheLock.acquire("bench-lock").release()
+
+    benchmark(acquire_release)
+
+
+def test_memcache_lock_acquire_held_no_wait(benchmark):
+    cache.clear()
+    lock = MemcacheLock.acquire("bench-lock")
+
+    assert benchmark(MemcacheLock.acquire, "bench-lock", wait=False) is None
+
+    lock.release()
+
+
+def test_memcache_lock_steal(benchmark):
+    """ Spinning on a held lock until it can be stolen """
+    cache.clear()
+    MemcacheLock.acquire("bench-lock")
+
+    benchmark(MemcacheLock.acquire, "bench-lock", steal_after_ms=5)
@@ -0,0 +1,102 @@
+"""
+    Benchmarks for Paginator.page, and how it stores and finds page markers.
+
+    The paginated queryset is backed by an in-memory list of instances rather
+    than the datastore, so that only the marker handling (and the cache) is measured.
+"""
+import bisect
+
+from django.core.cache import cache
+from django.db import models
+from django.db.models.query import QuerySet
+
+from djangae.contrib.pagination import (
+    Paginator,
+    paginated_model,
+)
+from djangae.contrib.pagination.decorators import generator
+
+from . import datasets
+
+_PER_PAGE = 20
+_PAGE_COUNT = 100
+
+
+class _StandInQuerySet(QuerySet):
+    """
+        Slices the model's in-memory `rows`, applying the marker filter that
+        Paginator.page adds
+    """
+
+    def __getitem__(self, k):
+        rows, values = self.model.rows, self.model.row_values
+
+        start = 0
+        for lookup in self.query.where.children:
+            if lookup.lookup_name == "gt":
+                start = bisect.bisect_right(values, lookup.rhs)
+
+        return rows[start:][k]
+
+
+@paginated_model(orderings=["name"])
+class BenchPaginatedModel(models.Model):
+    name = models.CharField(max_length=200)
+
+    objects = _StandInQuerySet.as_manager()
+
+    rows = []
+    row_values = []
+
+    class Meta:
+        app_label = "djangae"
+
+
+def _populate(count=_PER_PAGE * _PAGE_COUNT):
+    names = datasets.vocabulary(size=count)[:count]
+
+    rows = []
+    for i, name in enumerate(names):
+        instance = BenchPaginatedModel(pk=i + 1, name=name)
+        instance.pagination_name = generator(("name",), instance)
+        rows.append(instance)
+
+    rows.sort(key=lambda x: x.pagination_name)
+    BenchPaginatedModel.rows = rows
+    BenchPaginatedModel.row_values = [x.pagination_name for x in rows]
+
+
+def _paginator():
+    _populate()
+    return Paginator(BenchPaginatedModel.objects.order_by("name"), _PER_PAGE)
+
+
+def test_paginator_page_sequential(benchmark):
+    """ Walk through every page in order, as a user clicking "next" would """
+    paginator = _paginator()
+
+    def walk():
+        for number in range(1, _PAGE_COUNT + 1):
+            paginator.page(number)
+
+    benchmark.pedantic(walk, setup=cache.clear, rounds=20)
+
+
+def test_paginator_page_cached_markers(benchmark):
+    """ Jump to a page when the marker for the previous page is cached """
+    paginator = _paginator()
+    for number in range(1, _PAGE_COUNT + 1):
+        paginator.page(number)
+
+    benchmark(paginator.page, _PAGE_COUNT // 2)
+
+
+def test_paginator_page_no_markers(benchmark):
+    """ Jump to a late page with nothing cached, so every earlier marker is looked up """
+    paginator = _paginator()
+
+    def setup():
+        cache.clear()
+        return (_PAGE_COUNT,), {}
+
+    benchmark.pedantic(paginator.page, setup=setup, rounds=50)
@@ -0,0 +1,52 @@
+"""
+    Benchmarks for splitting querysets into key ranges.
+
+    Random keys come from a seeded stand-in for the scatter query, so that only
+    the sorting, splitting (and caching) of the sample is measured.
+"""
+import pytest
+from django.core.cache import cache
+from django.db import models
+
+from djangae.processing import datastore_key_ranges
+
+from . import datasets
+
+_OVERSAMPLING_FACTOR = 32
+
+
+class BenchKeyModel(models.Model):
+    class Meta:
+        app_label = "djangae"
+
+
+def _random_keys(queryset, shard_count):
+    return datasets.random_keys(shard_count * _OVERSAMPLING_FACTOR)
+
+
+@pytest.mark.parametrize("shard_count", [10, 100, 1000])
+def test_datastore_key_ranges(benchmark, shard_count):
+    benchmark(
+        datastore_key_ranges,
+        BenchKeyModel.objects.all(),
+        shard_count,
+        random_keys_getter=_random_keys,
+        cache_timeout=0,
+    )
+
+
+@pytest.mark.parametrize("shard_count", [10, 100, 1000])
+def test_datastore_key_ranges_cached_sample(benchmark, shard_count):
+    cache.clear()
+    queryset = BenchKeyModel.objects.all()
+
+    # Draw the sample for the largest shard count, so smaller ones reuse part of it
+    datastore_key_ranges(queryset, 1000, random_keys_getter=_random_keys, cache_timeout=60)
+
+    benchmark(
+        datastore_key_ranges,
+        queryset,
+        shard_count,
+        random_keys_getter=_random_keys,
+        cache_timeout=60,
+    )
@@ -0,0 +1,105 @@
+"""
+    Benchmarks for tokenizing content and queries, and for scoring search results.
+
+    `build_document_queryset` is run against an in-memory stand-in for the
+    TokenFieldIndex keys-only query, so that only the ranking work is measured.
+"""
+import bisect
+import types
+
+import pytest
+from django.db.models import Q
+
+from djangae.contrib import sleuth
+from djangae.contrib.search.models import TokenFieldIndex
+from djangae.contrib.search.query import (
+    _tokenize_query_string,
+    build_document_queryset,
+)
+from djangae.contrib.search.tokens import tokenize_content
+
+from . import datasets
+
+_INDEX = types.SimpleNamespace(id=1)
+
+
+def _key_ranges(filters):
+    """
+        Yields the (start, end) key ranges from the filters built by _build_filters
+    """
+    for child in filters.children:
+        if isinstance(child, Q):
+            yield from _key_ranges(child)
+
+    lookups = dict(x for x in filters.children if not isinstance(x, Q))
+    if "pk__gte" in lookups:
+        yield lookups["pk__gte"], lookups["pk__lt"]
+
+
+class _Keys(list):
+    def values_list(self, *args, **kwargs):
+        return self
+
+
+class _TokenFieldIndexStandIn:
+    """
+        Answers the keys-only range queries that build_document_queryset makes,
+        from a sorted list of keys
+    """
+
+    document_id_from_pk = TokenFieldIndex.document_id_from_pk
+
+    def __init__(self, keys):
+        self.keys = keys
+        self.objects = self
+
+    def filter(self, filters):
+        results = _Keys()
+        for start, end in _key_ranges(filters):
+            results.extend(self.keys[bisect.bisect_left(self.keys, start):bisect.bisect_left(self.keys, end)])
+        return results
+
+
+@pytest.fixture(scope="module")
+def token_index():
+    keys, words = datasets.token_index_keys(_INDEX.id)
+    return _TokenFieldIndexStandIn(keys), words
+
+
+def _search_all(queries, **kwargs):
+    for query in queries:
+        build_document_queryset(query, _INDEX, **kwargs)
+
+
+def test_tokenize_content(benchmark):
+    content = datasets.text_content()
+    benchmark(tokenize_content, content)
+
+
+def test_tokenize_query_string(benchmark):
+    queries = datasets.query_strings()
+
+    def tokenize_all():
+        for query in queries:
+            _tokenize_query_string(query, match_stopwords=False)
+
+    benchmark(tokenize_all)
+
+
+@pytest.mark.parametrize("match_all", [True, False])
+def test_build_document_queryset(benchmark, token_index, match_all):
+    index, _ = token_index
+    queries = datasets.query_strings()
+
+    with sleuth.switch("djangae.contrib.search.query.TokenFieldIndex", index):
+        benchmark(_search_all, queries, match_all=match_all)
+
+
+def test_build_document_queryset_startswith(benchmark, token_index):
+    index, words = token_index
+
+    # Short prefixes of common words match many documents
+    queries = [" ".join(word[:3] for word in words[i:i + 3]) for i in range(0, 60, 3)]
+
+    with sleuth.switch("djangae.contrib.search.query.TokenFieldIndex", index):
+        benchmark(_search_all, queries, use_startswith=True)
@@ -0,0 +1,94 @@
+"""
+    Seeded synthetic datasets for the benchmarks, so that runs are comparable
+    with saved baselines.
+"""
+import random
+import string
+
+# Roughly the shape of English text: a few very common words and a long tail
+_COMMON_WORDS = [
+    "the", "of", "and", "to", "in", "is", "you", "that", "it", "he", "was", "for", "on", "are", "as",
+]
+
+
+def vocabulary(size=5000, seed=0):
+    rng = random.Random(seed)
+    words = set()
+    while len(words) < size:
+        words.add("".join(rng.choice(string.ascii_lowercase) for _ in range(rng.randint(3, 12))))
+    return _COMMON_WORDS + sorted(words)
+
+
+def sentence_words(words, count, rng):
+    # Skewed, so earlier words in the vocabulary are much more frequent
+    return [words[int(len(words) * rng.random() ** 4)] for _ in range(count)]
+
+
+def text_content(word_count=2000, seed=0):
+    """
+        Returns a document of prose, with the punctuation, acronyms, dates and
+        email addresses which the tokenizer treats specially.
+    """
+    rng = random.Random(seed)
+    words = vocabulary(seed=seed)
+
+    specials = [
+        "I.B.M.", "C-I-A", "U.S.A", "2019-05-21", "21/05/2019", "o'clock",
+        "someone@example.com", "#hashtag", "C++", "1,000.50", "(bracketed)", "quote\"d",
+    ]
+
+    parts = []
+    for i, word in enumerate(sentence_words(words, word_count, rng)):
+        if rng.random() < 0.05:
+            word = rng.choice(specials)
+        elif i % 12 == 11:
+            word += rng.choice(".,;:!?")
+        parts.append(word)
+
+    return " ".join(parts)
+
+
+def query_strings(count=50, seed=0):
+    """
+        Returns search queries mixing plain words, field queries, exact phrases and ORs
+    """
+    rng = random.Random(seed)
+    words = vocabulary(seed=seed)
+
+    queries = []
+    for _ in range(count):
+        branches = []
+        for _ in range(rng.randint(1, 3)):
+            terms = sentence_words(words, rng.randint(1, 5), rng)
+            if rng.random() < 0.3:
+                terms[0] = "name:" + terms[0]
+            if len(terms) > 2 and rng.random() < 0.3:
+                terms = ['"%s %s"' % (terms[0], terms[1])] + terms[2:]
+            branches.append(" ".join(terms))
+        queries.append(" OR ".join(branches))
+    return queries
+
+
+def token_index_keys(index_id, document_count=2000, words_per_document=50, seed=0):
+    """
+        Returns the sorted TokenFieldIndex keys for a set of synthetic documents, i.e.
+        what the datastore would return for a keys-only query on the index, and the words
+        which were indexed.
+    """
+    from djangae.contrib.search.models import TokenFieldIndex
+
+    rng = random.Random(seed)
+    words = vocabulary(seed=seed)
+
+    keys = set()
+    for document_id in range(1, document_count + 1):
+        for word in set(sentence_words(words, words_per_document, rng)):
+            field_name = "name" if rng.random() < 0.1 else "text"
+            keys.add(TokenFieldIndex.generate_key(index_id, word, field_name, document_id, "rev"))
+
+    return sorted(keys), words
+
+
+def random_keys(count, seed=0):
+    rng = random.Random(seed)
+    return rng.sample(range(1, 2 ** 53), count)
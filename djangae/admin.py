@@ -1,5 +1,58 @@
 from django.contrib import admin
 
-from djangae.models import DeferIterationMarker
+from djangae.models import (
+    DeferIterationMarker,
+    DeferIterationShard,
+)
 
-admin.site.register(DeferIterationMarker)
+
+@admin.register(DeferIterationMarker)
+class DeferIterationMarkerAdmin(admin.ModelAdmin):
+    list_display = (
+        "pk",
+        "callback_name",
+        "finalize_name",
+        "created",
+        "shard_count",
+        "shards_complete",
+        "processed",
+        "estimated_total",
+        "throughput",
+        "eta",
+    )
+    readonly_fields = (
+        "processed",
+        "throughput",
+        "eta",
+    )
+
+    def _progress(self, obj):
+        # Each column needs the progress, which queries the shards
+        if not hasattr(obj, "_progress"):
+            obj._progress = obj.progress()
+        return obj._progress
+
+    def processed(self, obj):
+        return self._progress(obj)["processed"]
+
+    def throughput(self, obj):
+        throughput = self._progress(obj)["throughput"]
+        return "%.1f/s" % throughput if throughput is not None else "-"
+
+    def eta(self, obj):
+        return self._progress(obj)["eta"]
+
+
+@admin.register(DeferIterationShard)
+class DeferIterationShardAdmin(admin.ModelAdmin):
+    list_display = (
+        "marker_id",
+        "shard_number",
+        "processed_count",
+        "elapsed",
+        "started",
+        "updated",
+        "completed",
+    )
+    list_filter = ("marker_id",)
+    ordering = ("marker_id", "shard_number")
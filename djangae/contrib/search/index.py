@@ -1,16 +1,23 @@
 import uuid
 
 from collections.abc import Iterable
+from django import db
+from django.db import connections, router
 from gcloudc.db import transaction
 
 from djangae.contrib.search.document import Document
 from djangae.contrib.search.fields import IntegrityError
 from djangae.contrib.search import _SEARCH_QUEUE
+from djangae.contrib.search.constants import WORD_DOCUMENT_JOIN_STRING
 from djangae.contrib.search.models import DocumentRecord, TokenFieldIndex, IndexStats
 from djangae.tasks.deferred import defer_iteration_with_finalize
 
 _DEFAULT_INDEX_NAME = "default"
 
+# The datastore allows up to 500 mutations in a single commit, so this
+# is the most tokens we write in each (independent) transaction
+_MAX_TOKENS_PER_TRANSACTION = 500
+
 
 def _destroy_record(instance):
     instance.delete()
@@ -70,10 +77,35 @@ def unindex_document(document):
     return 1
 
 
+def _token_batch_size(tokens):
+    connection = connections[router.db_for_write(TokenFieldIndex)]
+    batch_size = connection.ops.bulk_batch_size(["id"], tokens) or len(tokens)
+    return max(1, min(batch_size, _MAX_TOKENS_PER_TRANSACTION))
+
+
+def _get_or_create_tokens(tokens):
+    for token in tokens:
+        with transaction.atomic(independent=True):
+            TokenFieldIndex.objects.get_or_create(
+                pk=token.pk,
+                defaults=dict(
+                    record_id=token.record_id,
+                    revision=token.revision,
+                    token=token.token,
+                    index_stats_id=token.index_stats_id,
+                    field_name=token.field_name
+                )
+            )
+
+
 def index_document(index_name, document):
 
     assert(document.id)  # This should be a thing by now
 
+    # Token keys are deterministic, so we build every token entity up-front
+    # (removing duplicates) and then write them in batches
+    tokens_by_key = {}
+
     for field_name, field in document.get_fields().items():
         if field_name == "id":
             continue
@@ -103,22 +135,38 @@ def index_document(index_name, document):
             if token is None or token == '':
                 continue
 
-            with transaction.atomic(independent=True):
-                # FIXME: Update occurrances
-                key = TokenFieldIndex.generate_key(
-                    index_name, token, field.attname, document.id, document.revision
-                )
+            # bulk_create doesn't call TokenFieldIndex.save(), so check the same things here
+            assert(token.strip())  # Check we're not indexing whitespace or nothing
+            assert(WORD_DOCUMENT_JOIN_STRING not in token)  # Don't index this special symbol
+
+            # FIXME: Update occurrances
+            key = TokenFieldIndex.generate_key(
+                index_name, token, field.attname, document.id, document.revision
+            )
+
+            tokens_by_key[key] = TokenFieldIndex(
+                pk=key,
+                record_id=document.id,
+                revision=document.revision,
+                token=token,
+                index_stats_id=index_name,
+                field_name=field.attname
+            )
+
+    tokens = list(tokens_by_key.values())
+    if not tokens:
+        return
 
-                obj, _ = TokenFieldIndex.objects.get_or_create(
-                    pk=key,
-                    defaults=dict(
-                        record_id=document.id,
-                        revision=document.revision,
-                        token=token,
-                        index_stats_id=index_name,
-                        field_name=field.attname
-                    )
-                )
+    batch_size = _token_batch_size(tokens)
+    for i in range(0, len(tokens), batch_size):
+        batch = tokens[i:i + batch_size]
+        try:
+            with transaction.atomic(independent=True):
+                TokenFieldIndex.objects.bulk_create(batch)
+        except db.IntegrityError:
+            # Some of these tokens already exist (e.g. this document is being indexed again
+            # after a failure) and bulk_create won't overwrite them, so create them one by one
+            _get_or_create_tokens(batch)
 
 
 class Index(object):
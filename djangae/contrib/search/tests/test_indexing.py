@@ -1,8 +1,9 @@
 from unittest import skip, mock
 
+from djangae.contrib import sleuth
 from djangae.contrib.search import fields
 from djangae.contrib.search.document import Document
-from djangae.contrib.search.index import Index
+from djangae.contrib.search.index import Index, index_document
 from djangae.contrib.search.models import TokenFieldIndex
 from djangae.contrib.search.tokens import tokenize_content, acronyms
 from djangae.test import TestCase
@@ -209,6 +210,44 @@ class IndexingTests(TestCase):
         self.assertEqual(index.document_count(), 1)
         self.assertEqual(TokenFieldIndex.objects.count(), 1)  # Just "pipes"
 
+    def test_tokens_written_in_batches(self):
+        class Doc(Document):
+            text = fields.TextField()
+            name = fields.TextField()
+
+        index = Index(name="test")
+        words = ["word%s" % i for i in range(25)]
+
+        with sleuth.switch("djangae.contrib.search.index._MAX_TOKENS_PER_TRANSACTION", 10):
+            with sleuth.watch("django.db.models.query.QuerySet.bulk_create") as bulk_create:
+                doc = Doc(text=" ".join(words + words), name="word0 name")
+                index.add(doc)
+
+        # 25 distinct words in text, and 2 in name
+        self.assertEqual(bulk_create.call_count, 3)
+        self.assertTrue(all(len(call.args[1]) <= 10 for call in bulk_create.calls))
+        self.assertEqual(TokenFieldIndex.objects.filter(record_id=doc.id).count(), 27)
+
+        results = list(index.search("name:word0", Doc))
+        self.assertEqual([x.id for x in results], [doc.id])
+
+    def test_indexing_again_keeps_existing_tokens(self):
+        class Doc(Document):
+            text = fields.TextField()
+
+        index = Index(name="test")
+        doc = Doc(text="one two three")
+        index.add(doc)
+
+        # e.g. a retry after indexing failed part way through
+        TokenFieldIndex.objects.filter(token="two").delete()
+        index_document(index.name, doc)
+
+        self.assertCountEqual(
+            TokenFieldIndex.objects.filter(record_id=doc.id).values_list("token", flat=True),
+            ["one", "two", "three"]
+        )
+
     def test_null_validation(self):
         """
             If a field is marked as null=False, and someone tries to index
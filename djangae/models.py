@@ -1,4 +1,8 @@
+import pickle
+from datetime import timedelta
+
 from django.db import models
+from django.utils import timezone
 
 from djangae import patches  # noqa
 
@@ -13,8 +17,17 @@ class DeferIterationMarker(models.Model):
     is_ready = models.BooleanField(default=False)
 
     shard_count = models.PositiveIntegerField(default=0)
+
+    # Shards record their own completion on their DeferIterationShard, so that they
+    # don't contend on this entity. This is only set once they have all completed.
     shards_complete = models.PositiveIntegerField(default=0)
 
+    # Set by the shard which defers the finalize, so that it only happens once
+    finalize_queued = models.BooleanField(default=False)
+
+    # The number of instances in the queryset when the shards were generated, if counted
+    estimated_total = models.PositiveIntegerField(null=True)
+
     delete_on_completion = models.BooleanField(default=True)
 
     created = models.DateTimeField(auto_now_add=True)
@@ -28,9 +41,149 @@ class DeferIterationMarker(models.Model):
     def is_finished(self):
         return self.is_ready and self.shard_count == self.shards_complete
 
+    def progress(self):
+        """
+            Returns a dictionary describing the progress of the iteration, aggregated
+            from its shards. Throughput is in instances per second, and the
+            ETA can only be estimated if `estimated_total` was recorded.
+        """
+        shards = list(DeferIterationShard.objects.filter(marker_id=self.pk).order_by("shard_number"))
+        processed = sum(x.processed_count for x in shards)
+
+        now = timezone.now()
+        started = min((x.started for x in shards if x.started), default=None)
+        completed = None
+        if self.is_finished:
+            completed = max((x.completed for x in shards if x.completed), default=None)
+
+        running_time = ((completed or now) - started).total_seconds() if started else 0
+        throughput = processed / running_time if running_time else None
+
+        eta = completed
+        if not completed and throughput and self.estimated_total is not None:
+            remaining = max(self.estimated_total - processed, 0)
+            eta = now + timedelta(seconds=remaining / throughput)
+
+        return {
+            "id": self.pk,
+            "callback_name": self.callback_name,
+            "finalize_name": self.finalize_name,
+            "created": self.created,
+            "is_finished": self.is_finished,
+            "shard_count": self.shard_count,
+            "shards_complete": sum(1 for x in shards if x.completed),
+            "processed": processed,
+            "estimated_total": self.estimated_total,
+            "started": started,
+            "completed": completed,
+            "throughput": throughput,
+            "eta": eta,
+            "shards": [x.progress() for x in shards],
+        }
+
     def __unicode__(self):
         return "Background Task (%s -> %s) at %s" % (
             self.callback_name,
             self.finalize_name,
             self.created
         )
+
+
+class DeferIterationShard(models.Model):
+    """
+        Checkpoint of the progress of a single shard of
+        a sharded defer iteration
+    """
+
+    # "<marker_id>-<shard_number>", so that we can look this up without a query
+    id = models.CharField(primary_key=True, max_length=100)
+
+    marker_id = models.BigIntegerField()
+    shard_number = models.PositiveIntegerField()
+
+    # Pickled primary key of the last instance which was successfully processed
+    last_key_data = models.BinaryField(null=True)
+
+    # Pickled primary key that this shard stops before, set when the
+    # shard's remaining range was split off into a new shard
+    end_key_data = models.BinaryField(null=True)
+
+    # Pickled partial result of a defer_iteration_with_reduce, which is saved
+    # along with last_key so that they stay consistent
+    result_data = models.BinaryField(null=True)
+
+    # Progress counters. `elapsed` is the total time (in seconds) spent processing
+    # the shard, across all of the tasks which have worked on it
+    processed_count = models.PositiveIntegerField(default=0)
+
+    # The number of instances in the shard's range, if the key ranges getter estimated it
+    estimated_count = models.PositiveIntegerField(null=True)
+    elapsed = models.FloatField(default=0)
+    started = models.DateTimeField(null=True)
+    completed = models.DateTimeField(null=True)
+
+    updated = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        app_label = "djangae"
+
+    @classmethod
+    def make_id(cls, marker_id, shard_number):
+        return "%s-%s" % (marker_id, shard_number)
+
+    @classmethod
+    def for_shard(cls, marker_id, shard_number):
+        """
+            Returns the checkpoint for the shard, or a new
+            (unsaved) one if there isn't one yet
+        """
+        pk = cls.make_id(marker_id, shard_number)
+        return cls.objects.filter(pk=pk).first() or cls(
+            pk=pk, marker_id=marker_id, shard_number=shard_number
+        )
+
+    @property
+    def last_key(self):
+        if self.last_key_data is None:
+            return None
+        return pickle.loads(self.last_key_data)
+
+    @last_key.setter
+    def last_key(self, value):
+        self.last_key_data = pickle.dumps(value)
+
+    @property
+    def end_key(self):
+        if self.end_key_data is None:
+            return None
+        return pickle.loads(self.end_key_data)
+
+    @end_key.setter
+    def end_key(self, value):
+        self.end_key_data = None if value is None else pickle.dumps(value)
+
+    @property
+    def result(self):
+        if self.result_data is None:
+            return None
+        return pickle.loads(self.result_data)
+
+    @result.setter
+    def result(self, value):
+        self.result_data = pickle.dumps(value)
+
+    def progress(self):
+        return {
+            "shard_number": self.shard_number,
+            "processed": self.processed_count,
+            "estimated_count": self.estimated_count,
+            "elapsed": self.elapsed,
+            "throughput": self.processed_count / self.elapsed if self.elapsed else None,
+            "last_key": self.last_key,
+            "started": self.started,
+            "updated": self.updated,
+            "completed": self.completed,
+        }
+
+    def __str__(self):
+        return "Shard %s of %s" % (self.shard_number, self.marker_id)
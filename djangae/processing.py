@@ -1,6 +1,16 @@
+import bisect
+import hashlib
+import pickle
+import time
+import uuid
 from math import ceil
-from typing import Callable
+from typing import (
+    Callable,
+    Optional,
+)
 
+from django.conf import settings
+from django.core.cache import cache
 from django.db.models.query import QuerySet
 try:
     # This gets moved in gcloudc as part of the Firestore backend implementation
@@ -9,6 +19,28 @@ except ImportError:
     from gcloudc.db.backends.common.expressions import Scatter
 
 
+# If set, samples of random keys are cached (in the Django cache) for this many
+# seconds. After that the next caller refreshes the sample while other callers
+# carry on with the stale one, until it's twice this age.
+_SAMPLE_CACHE_TIMEOUT_SETTING = "DJANGAE_KEY_RANGES_SAMPLE_CACHE_TIMEOUT"
+
+# How long a refresh of a cached sample can take before another caller tries
+_SAMPLE_REFRESH_LOCK_TIMEOUT = 60
+
+# Interpolated key ranges probe the key space by fetching this many keys from a point
+_PROBE_SIZE = 32
+
+# ...and start by probing this many evenly spaced points per shard, then bisect the
+# parts of the key space which look most populated, up to a total number of probes
+_INITIAL_PROBES_PER_SHARD = 4
+_PROBES_PER_SHARD = 16
+_MIN_PROBES = 32
+_MAX_PROBES = 1024
+
+# How many characters of string keys are used when interpolating between them
+_STRING_KEY_PRECISION = 12
+
+
 def _find_random_keys(queryset: QuerySet, shard_count: int) -> list:
     OVERSAMPLING_FACTOR = 32
 
@@ -19,6 +51,119 @@ def _find_random_keys(queryset: QuerySet, shard_count: int) -> list:
     )
 
 
+def _sample_cache_key(queryset: QuerySet, random_keys_getter: Callable) -> Optional[str]:
+    try:
+        where = pickle.dumps(queryset.query.where)
+    except Exception:
+        # Can't tell the filters apart, so don't cache
+        return None
+
+    getter = getattr(random_keys_getter, "__qualname__", None)
+    if getter is None:
+        return None
+
+    digest = hashlib.md5(
+        where + random_keys_getter.__module__.encode("utf-8") + getter.encode("utf-8")
+    ).hexdigest()
+
+    return "djangae-key-sample:%s:%s:%s" % (queryset.db, queryset.model._meta.label_lower, digest)
+
+
+def _cached_random_keys(
+    queryset: QuerySet,
+    shard_count: int,
+    random_keys_getter: Callable[[QuerySet, int], list],
+    timeout: int,
+) -> list:
+    """
+        Returns random keys from `random_keys_getter`, caching them per model, filter
+        and getter. A sample drawn for more shards is reused for fewer shards by
+        taking the same proportion of its keys. As scatter ordered samples are
+        deterministic, that's what a smaller query would have returned anyway, so shard
+        boundaries stay the same between runs.
+    """
+    cache_key = _sample_cache_key(queryset, random_keys_getter)
+    if cache_key is None:
+        return random_keys_getter(queryset, shard_count)
+
+    now = time.time()
+    sample_shard_count = shard_count
+
+    entry = cache.get(cache_key)
+    if entry and entry["shard_count"] >= shard_count:
+        is_fresh = (now - entry["created"]) < timeout
+        if is_fresh or not cache.add(cache_key + ":refresh", True, _SAMPLE_REFRESH_LOCK_TIMEOUT):
+            keys = entry["keys"]
+            return list(keys[:ceil(len(keys) * shard_count / entry["shard_count"])])
+
+        # We're refreshing the stale sample, so keep it the same size
+        sample_shard_count = entry["shard_count"]
+
+    keys = list(random_keys_getter(queryset, sample_shard_count))
+    cache.set(cache_key, {"keys": keys, "shard_count": sample_shard_count, "created": now}, timeout * 2)
+    cache.delete(cache_key + ":refresh")
+
+    return keys[:ceil(len(keys) * shard_count / sample_shard_count)]
+
+
+class KeyRanges(list):
+    """
+        A list of (start, end) key ranges, as returned by a key ranges getter, which
+        also knows the estimated number of instances in each range (`populations`)
+    """
+
+    def __init__(self, ranges, populations=None):
+        super().__init__(ranges)
+        self.populations = populations
+
+
+def quantile_key_ranges(queryset: QuerySet, shard_count: int) -> KeyRanges:
+    """
+        Given a queryset and a number of shards, returns key ranges which each
+        contain (roughly) the same number of instances, however sparse or clustered
+        the keys are. The returned KeyRanges has the number of instances in each
+        range as its `populations`.
+
+        This counts the keys in the queryset, and then fetches the key at the start of
+        each range with a keys-only query at an offset from the start of the previous
+        range. That's the equivalent of reading every key once, so this is more expensive
+        than the other key ranges getters for very large querysets.
+    """
+    keys = queryset.order_by("pk").values_list("pk", flat=True)
+    total = keys.count()
+
+    if shard_count < 2 or total < 2:
+        return KeyRanges([(None, None)], [total])
+
+    shard_count = min(shard_count, total)
+    offsets = [total * i // shard_count for i in range(shard_count)] + [total]
+
+    split_keys = []
+    for offset, previous in zip(offsets[1:-1], offsets):
+        if split_keys:
+            index = offset - previous - 1
+            page = list(keys.filter(pk__gt=split_keys[-1])[index:index + 1])
+        else:
+            page = list(keys[offset:offset + 1])
+
+        if not page:
+            # Instances were deleted since counting
+            break
+
+        split_keys.append(page[0])
+
+    if not split_keys:
+        return KeyRanges([(None, None)], [total])
+
+    ranges = [(None, split_keys[0])] + [
+        (split_keys[i], split_keys[i + 1]) for i in range(len(split_keys) - 1)
+    ] + [(split_keys[-1], None)]
+
+    offsets = offsets[:len(split_keys) + 1] + [total]
+    populations = [end - start for start, end in zip(offsets, offsets[1:])]
+    return KeyRanges(ranges, populations)
+
+
 def sequential_int_key_ranges(queryset, shard_count):
     """
         Given a queryset and a number of shards.
@@ -54,6 +199,7 @@ def datastore_key_ranges(
     queryset: QuerySet,
     shard_count: int,
     random_keys_getter: Callable[[QuerySet, int], list] = _find_random_keys,
+    cache_timeout: Optional[int] = None,
 ) -> list:
     """
         Given a queryset and a number of shard. This function makes use of the
@@ -64,11 +210,20 @@ def datastore_key_ranges(
         generated for a given model, e.g. `_find_random_keys` uses the `objects` model manager,
         other implementations can use a different model manager.
         This is especially useful on AppEngine Python 3 which no longer allows `__scatter__` indexes.
+
+        If `cache_timeout` (which defaults to the DJANGAE_KEY_RANGES_SAMPLE_CACHE_TIMEOUT setting)
+        is set, the random keys are cached for that many seconds.
     """
 
+    if cache_timeout is None:
+        cache_timeout = getattr(settings, _SAMPLE_CACHE_TIMEOUT_SETTING, None)
+
     if shard_count > 1:
         # Use the scatter property to generate shard points
-        random_keys = random_keys_getter(queryset, shard_count)
+        if cache_timeout:
+            random_keys = _cached_random_keys(queryset, shard_count, random_keys_getter, cache_timeout)
+        else:
+            random_keys = random_keys_getter(queryset, shard_count)
 
         if not random_keys:
             # No random keys? Don't shard
@@ -91,3 +246,174 @@ def datastore_key_ranges(
         key_ranges = [(None, None)]
 
     return key_ranges
+
+
+def _interpolated_key_ranges(queryset, shard_count, first, last, to_number, from_number):
+    """
+        Splits the keys between `first` and `last` into `shard_count` ranges of roughly
+        equal population. `to_number` maps a key to a number (preserving ordering) and
+        `from_number` maps a number back to a key.
+
+        The number space is divided up into intervals, and the population of each is
+        estimated by probing the first few keys from its start. Intervals which aren't
+        completely seen by their probe are estimated from the density of the keys that
+        were, and the most populated ones are bisected (which costs a single probe)
+        until the budget of probes is used up. Split points are then interpolated
+        within the intervals to give each shard an equal share.
+    """
+
+    def probe(start):
+        keys = queryset.filter(pk__gte=from_number(start)).order_by("pk").values_list("pk", flat=True)
+        return [to_number(x) for x in keys[:_PROBE_SIZE]]
+
+    def estimate(start, end, found):
+        # Returns the estimated number of keys in the interval, and whether that's exact
+        in_range = [x for x in found if x < end]
+        if len(in_range) < len(found) or len(found) < _PROBE_SIZE:
+            return len(in_range), True
+
+        span = max(found[-1] - found[0], 1)
+        return len(found) * (end - found[0]) / span, False
+
+    low, high = to_number(first), to_number(last) + 1
+
+    # start -> [end, found, population, exact]
+    intervals = {}
+
+    initial_count = shard_count * _INITIAL_PROBES_PER_SHARD
+    grid = sorted({low + (high - low) * i // initial_count for i in range(initial_count)}) + [high]
+    for start, end in zip(grid, grid[1:]):
+        found = probe(start)
+        intervals[start] = [end, found, *estimate(start, end, found)]
+
+    budget = min(max(shard_count * _PROBES_PER_SHARD, _MIN_PROBES), _MAX_PROBES) - len(intervals)
+    while budget > 0:
+        candidates = [(x[2], start) for start, x in intervals.items() if not x[3] and x[0] - start > 1]
+        if not candidates:
+            break
+
+        _, start = max(candidates)
+        end, found = intervals[start][:2]
+        middle = start + (end - start) // 2
+
+        # The first half starts at the same point, so can reuse the probe
+        intervals[start] = [middle, found, *estimate(start, middle, found)]
+        found = probe(middle)
+        intervals[middle] = [end, found, *estimate(middle, end, found)]
+        budget -= 1
+
+    starts = sorted(intervals)
+    populations = [intervals[x][2] for x in starts]
+    total = sum(populations)
+
+    split_keys = []
+    cumulative = 0
+    i = 0
+    for shard in range(1, shard_count):
+        target = total * shard / shard_count
+        while i < len(starts) and cumulative + populations[i] < target:
+            cumulative += populations[i]
+            i += 1
+
+        if i == len(starts):
+            break
+
+        start = starts[i]
+        fraction = (target - cumulative) / populations[i]
+        key = from_number(start + int((intervals[start][0] - start) * fraction))
+
+        if key > first and (not split_keys or key > split_keys[-1]):
+            split_keys.append(key)
+
+    if not split_keys:
+        return [(None, None)]
+
+    return [(None, split_keys[0])] + [
+        (split_keys[i], split_keys[i + 1]) for i in range(len(split_keys) - 1)
+    ] + [(split_keys[-1], None)]
+
+
+def _first_and_last_keys(queryset, count=1):
+    keys = queryset.values_list("pk", flat=True)
+    return list(keys.order_by("pk")[:count]), list(keys.order_by("-pk")[:count])
+
+
+def sparse_int_key_ranges(queryset: QuerySet, shard_count: int) -> list:
+    """
+        Given a queryset and a number of shards, returns key ranges for a model
+        with integer primary keys, which don't need to be dense or sequential. The
+        key space between the smallest and biggest key is split up by interpolation,
+        refined with keys-only queries, so this doesn't need a scatter index.
+    """
+    first, last = _first_and_last_keys(queryset)
+    if shard_count < 2 or not first or first[0] == last[0]:
+        return [(None, None)]
+
+    return _interpolated_key_ranges(queryset, shard_count, first[0], last[0], int, int)
+
+
+def uuid_key_ranges(queryset: QuerySet, shard_count: int) -> list:
+    """
+        Given a queryset and a number of shards, returns key ranges for a model
+        with UUID primary keys (either a UUIDField, or UUID strings) without
+        needing a scatter index.
+    """
+    first, last = _first_and_last_keys(queryset)
+    if shard_count < 2 or not first or first[0] == last[0]:
+        return [(None, None)]
+
+    first, last = first[0], last[0]
+
+    def to_number(key):
+        return (key if isinstance(key, uuid.UUID) else uuid.UUID(key)).int
+
+    def from_number(number):
+        key = uuid.UUID(int=number)
+        if isinstance(first, uuid.UUID):
+            return key
+        # Match the format of the stored keys
+        return str(key) if "-" in first else key.hex
+
+    return _interpolated_key_ranges(queryset, shard_count, first, last, to_number, from_number)
+
+
+def string_key_ranges(queryset: QuerySet, shard_count: int) -> list:
+    """
+        Given a queryset and a number of shards, returns key ranges for a model
+        with string primary keys without needing a scatter index.
+
+        Keys are treated as numbers in a base made up of the characters seen
+        in the first and last keys, up to a precision of 12 characters.
+    """
+    first, last = _first_and_last_keys(queryset, count=_PROBE_SIZE)
+    if shard_count < 2 or not first or first[0] == last[0]:
+        return [(None, None)]
+
+    samples = first + last
+    length = max(min(max(len(x) for x in samples), _STRING_KEY_PRECISION), 1)
+    alphabet = sorted(set("".join(x[:length] for x in samples)))
+
+    # 0 is used for the end of a shorter string (which sorts before any character)
+    base = len(alphabet) + 1
+
+    def to_number(key):
+        number = 0
+        for i in range(length):
+            digit = bisect.bisect_right(alphabet, key[i]) if i < len(key) else 0
+            number = number * base + digit
+        return number
+
+    def from_number(number):
+        digits = []
+        for i in range(length):
+            number, digit = divmod(number, base)
+            digits.append(digit)
+
+        key = []
+        for digit in reversed(digits):
+            if not digit:
+                break
+            key.append(alphabet[digit - 1])
+        return "".join(key)
+
+    return _interpolated_key_ranges(queryset, shard_count, first[0], last[0], to_number, from_number)
@@ -3,6 +3,7 @@ from djangae.environment import project_id as gae_project_id
 
 import logging
 import os
+import threading
 import grpc
 from google.protobuf import field_mask_pb2
 
@@ -12,9 +13,10 @@ CLOUD_TASKS_PROJECT_SETTING = "CLOUD_TASKS_PROJECT_ID"
 CLOUD_TASKS_LOCATION_SETTING = "CLOUD_TASKS_LOCATION"
 
 
-def get_cloud_tasks_client():
+def _create_cloud_tasks_client(host=None):
     """
-        Get an instance of a Google CloudTasksClient
+        Constructs a new CloudTasksClient. If `host` is specified then
+        the client connects to the emulator running there.
 
         Note. Nested imports are to allow for things not to
         force the google cloud tasks dependency if you're not
@@ -22,28 +24,97 @@ def get_cloud_tasks_client():
     """
     from google.cloud.tasks import CloudTasksClient
 
+    if not host:
+        return CloudTasksClient()
+
+    try:
+        # google-cloud-tasks < 2.0.0 has this here
+        from google.cloud.tasks_v2.gapic.transports.cloud_tasks_grpc_transport import CloudTasksGrpcTransport
+    except ImportError:
+        from google.cloud.tasks_v2.services.cloud_tasks.transports.grpc import CloudTasksGrpcTransport
+
+    from google.api_core.client_options import ClientOptions
+
+    return CloudTasksClient(
+        transport=CloudTasksGrpcTransport(channel=grpc.insecure_channel(host)),
+        client_options=ClientOptions(api_endpoint=host)
+    )
+
+
+class CloudTasksClientManager:
+    """
+        Keeps a process-wide cache of CloudTasksClient instances (and therefore
+        their gRPC channels) keyed by endpoint, so that we don't pay for client
+        construction and a new connection every time we defer a task.
+
+        Clients are thread-safe, but gRPC channels must not be shared across
+        a fork(), so the cache is discarded if the process ID changes.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._clients = {}
+        self._pid = os.getpid()
+        self.creations = 0
+        self.reuses = 0
+
+    def _check_pid(self):
+        pid = os.getpid()
+        if pid != self._pid:
+            # We've been forked, the inherited channels are unusable
+            self._clients = {}
+            self._lock = threading.Lock()
+            self._pid = pid
+
+    def get_client(self, host=None):
+        self._check_pid()
+
+        with self._lock:
+            client = self._clients.get(host)
+            if client is None:
+                client = self._clients[host] = _create_cloud_tasks_client(host)
+                self.creations += 1
+            else:
+                self.reuses += 1
+
+            return client
+
+    def clear(self):
+        with self._lock:
+            self._clients = {}
+
+    def stats(self):
+        return {
+            "clients": len(self._clients),
+            "creations": self.creations,
+            "reuses": self.reuses,
+        }
+
+
+_client_manager = CloudTasksClientManager()
+
+
+def get_cloud_tasks_client():
+    """
+        Get an instance of a Google CloudTasksClient. Clients are cached
+        and reused for the lifetime of the process.
+    """
     is_app_engine = os.environ.get("GAE_ENV") == "standard"
 
     if is_app_engine:
-        return CloudTasksClient()
+        return _client_manager.get_client()
     else:
         # Running locally, try to connect to the emulator
-
-        try:
-            # google-cloud-tasks < 2.0.0 has this here
-            from google.cloud.tasks_v2.gapic.transports.cloud_tasks_grpc_transport import CloudTasksGrpcTransport
-        except ImportError:
-            from google.cloud.tasks_v2.services.cloud_tasks.transports.grpc import CloudTasksGrpcTransport
-
-        from google.api_core.client_options import ClientOptions
-
         host = os.environ.get("TASKS_EMULATOR_HOST", "127.0.0.1:9022")
+        return _client_manager.get_client(host)
 
-        client = CloudTasksClient(
-            transport=CloudTasksGrpcTransport(channel=grpc.insecure_channel(host)),
-            client_options=ClientOptions(api_endpoint=host)
-        )
-        return client
+
+def cloud_tasks_client_stats():
+    """
+        Returns a dictionary of the number of cached clients, and how many
+        times a client has been created or reused.
+    """
+    return _client_manager.stats()
 
 
 def ensure_required_queues_exist():
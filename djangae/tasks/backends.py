@@ -0,0 +1,398 @@
+"""
+    Backends which defer() submits tasks to. The backend is configured with
+    settings.DJANGAE_DEFERRED_BACKEND (the import path of a backend class) and
+    settings.DJANGAE_DEFERRED_BACKEND_OPTIONS (a dictionary of keyword arguments
+    to pass to it).
+
+    CloudTasksBackend is the default. ThreadPoolBackend and ProcessPoolBackend run
+    tasks in the current process (or child processes) which avoids the round trip
+    through Cloud Tasks for management commands, batch jobs and local development.
+"""
+
+import contextlib
+import logging
+import threading
+import time
+import uuid
+from concurrent.futures import (
+    Future,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    wait as wait_for_futures,
+)
+from datetime import (
+    timedelta,
+    timezone as dt_timezone,
+)
+
+from django.conf import settings
+from django.db import connections
+from django.utils import timezone
+from django.utils.module_loading import import_string
+from google.api_core import exceptions
+
+from .environment import _TASK_ENV
+
+logger = logging.getLogger(__name__)
+
+_BACKEND_SETTING = "DJANGAE_DEFERRED_BACKEND"
+_BACKEND_OPTIONS_SETTING = "DJANGAE_DEFERRED_BACKEND_OPTIONS"
+_DEFAULT_BACKEND = "djangae.tasks.backends.CloudTasksBackend"
+
+_backends = {}
+_backends_lock = threading.Lock()
+
+
+def _aware_eta(eta):
+    """
+        Returns a task's _eta as an aware datetime. Cloud Tasks treats naive
+        datetimes as UTC, so that's what we do too.
+    """
+    if eta and timezone.is_naive(eta):
+        return timezone.make_aware(eta, dt_timezone.utc)
+    return eta
+
+
+class BaseTaskBackend:
+    def schedule(
+        self, project_id, location, queue, payload,
+        task_args, small_task, deferred_handler_url, task_headers
+    ):
+        """ Submits a task with the serialized payload from defer() """
+        raise NotImplementedError()
+
+
+class CloudTasksBackend(BaseTaskBackend):
+    """ Submits tasks to Google Cloud Tasks """
+
+    def schedule(self, *args):
+        from .deferred import _schedule_task
+        return _schedule_task(*args)
+
+
+@contextlib.contextmanager
+def _task_environment(task_name, queue, execution_count):
+    """
+        Sets up djangae.tasks.environment as the middleware would for
+        a task request
+    """
+    _TASK_ENV.task_name = task_name
+    _TASK_ENV.queue_name = queue
+    _TASK_ENV.task_execution_count = execution_count
+    _TASK_ENV.task_retry_count = execution_count
+    try:
+        yield
+    finally:
+        for attr in ("task_name", "queue_name", "task_execution_count", "task_retry_count"):
+            setattr(_TASK_ENV, attr, None)
+
+
+def _run_payload(payload, queue, task_name, execution_count):
+    from .instrumentation import run_task_payload
+
+    with _task_environment(task_name, queue, execution_count):
+        return run_task_payload(payload, queue=queue, execution_count=execution_count)
+
+
+def _run_task(payload, queue, task_name, max_attempts, retry_delay):
+    """
+        Runs a task payload with the same semantics as the deferred handler. Tasks
+        raising SingularTaskFailure (or any other exception) are retried up to
+        max_attempts times, PermanentTaskFailure is never retried.
+    """
+    from .deferred import PermanentTaskFailure, SingularTaskFailure
+
+    attempt = 0
+    while True:
+        attempt += 1
+
+        try:
+            return _run_payload(payload, queue, task_name, attempt - 1)
+        except PermanentTaskFailure:
+            logger.exception("Permanent failure attempting to execute task")
+            return None
+        except Exception as e:
+            if attempt >= max_attempts:
+                logger.exception("Task %s failed after %s attempts", task_name, attempt)
+                raise
+
+            if isinstance(e, SingularTaskFailure):
+                logger.debug("Failure executing task, task retry forced")
+            else:
+                logger.exception("Error executing task %s, retrying", task_name)
+
+            time.sleep(retry_delay * (2 ** (attempt - 1)))
+        finally:
+            # Don't leak database connections from worker threads
+            connections.close_all()
+
+
+def _init_worker_process():
+    import django
+    django.setup()
+
+    # Connections inherited from the parent process can't be shared
+    connections.close_all()
+
+
+class _ExecutorBackend(BaseTaskBackend):
+    """
+        Runs tasks on an executor per queue, honouring _countdown and _eta by
+        delaying submission to the executor.
+    """
+
+    executor_class = None
+
+    def __init__(self, max_workers=None, max_attempts=5, retry_delay=0.1):
+        self.max_workers = max_workers
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+
+        self._lock = threading.Lock()
+        self._executors = {}
+        self._pending = set()
+        self._names = set()
+
+    def create_executor(self, queue):
+        return self.executor_class(max_workers=self.max_workers)
+
+    def _get_executor(self, queue):
+        with self._lock:
+            if queue not in self._executors:
+                self._executors[queue] = self.create_executor(queue)
+            return self._executors[queue]
+
+    def _track(self, future):
+        with self._lock:
+            self._pending.add(future)
+
+        def done(f):
+            with self._lock:
+                self._pending.discard(f)
+
+        future.add_done_callback(done)
+
+    def _submit(self, queue, payload, name, future):
+        if not future.set_running_or_notify_cancel():
+            return
+
+        try:
+            source = self._get_executor(queue).submit(
+                _run_task, payload, queue, name, self.max_attempts, self.retry_delay
+            )
+        except Exception as e:
+            future.set_exception(e)
+            return
+
+        def copy_result(f):
+            if f.exception():
+                future.set_exception(f.exception())
+            else:
+                future.set_result(f.result())
+
+        source.add_done_callback(copy_result)
+
+    def schedule(
+        self, project_id, location, queue, payload,
+        task_args, small_task, deferred_handler_url, task_headers
+    ):
+        name = task_args["name"]
+        if name:
+            with self._lock:
+                if name in self._names:
+                    raise exceptions.AlreadyExists("Task %s already exists" % name)
+                self._names.add(name)
+        else:
+            name = uuid.uuid4().hex
+
+        delay = 0
+        if task_args["countdown"]:
+            delay = task_args["countdown"]
+        elif task_args["eta"]:
+            delay = (_aware_eta(task_args["eta"]) - timezone.now()).total_seconds()
+
+        # Returned to the caller, completes with the return value of the task
+        future = Future()
+        self._track(future)
+
+        if delay > 0:
+            timer = threading.Timer(delay, self._submit, (queue, payload, name, future))
+            timer.daemon = True
+            timer.start()
+        else:
+            self._submit(queue, payload, name, future)
+
+        return future
+
+    def wait(self, timeout=None):
+        """
+            Blocks until all tasks (including any they defer) have completed, or
+            timeout seconds have passed. Returns True if everything completed.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+
+        while True:
+            with self._lock:
+                pending = set(self._pending)
+
+            if not pending:
+                return True
+
+            remaining = None if deadline is None else max(0, deadline - time.monotonic())
+            wait_for_futures(pending, timeout=remaining)
+
+            if deadline is not None and time.monotonic() >= deadline:
+                with self._lock:
+                    return not self._pending
+
+    def shutdown(self, wait=True):
+        with self._lock:
+            executors, self._executors = self._executors, {}
+
+        for executor in executors.values():
+            executor.shutdown(wait=wait)
+
+
+class ThreadPoolBackend(_ExecutorBackend):
+    """ Runs tasks on a thread pool in the current process """
+    executor_class = ThreadPoolExecutor
+
+
+class ProcessPoolBackend(_ExecutorBackend):
+    """
+        Runs tasks on a pool of worker processes. Tasks which defer other
+        tasks will submit them using the backend configured in the worker.
+    """
+    executor_class = ProcessPoolExecutor
+
+    def create_executor(self, queue):
+        return self.executor_class(max_workers=self.max_workers, initializer=_init_worker_process)
+
+
+class InMemoryTask:
+    def __init__(self, name, queue, payload, eta):
+        self.name = name
+        self.queue = queue
+        self.payload = payload
+        self.eta = eta
+        self.execution_count = 0
+
+    def __repr__(self):
+        return "<InMemoryTask %s on %s>" % (self.name, self.queue)
+
+
+class InMemoryBackend(BaseTaskBackend):
+    """
+        Holds tasks in memory until they are explicitly run, this is used
+        by djangae.test.TestCase when `in_memory_task_queue` is True
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._tasks = []
+        self._names = set()
+
+    def schedule(
+        self, project_id, location, queue, payload,
+        task_args, small_task, deferred_handler_url, task_headers
+    ):
+        name = task_args["name"]
+        with self._lock:
+            if name:
+                if name in self._names:
+                    raise exceptions.AlreadyExists("Task %s already exists" % name)
+                self._names.add(name)
+            else:
+                name = uuid.uuid4().hex
+
+            eta = timezone.now()
+            if task_args["countdown"]:
+                eta += timedelta(seconds=task_args["countdown"])
+            elif task_args["eta"]:
+                eta = _aware_eta(task_args["eta"])
+
+            task = InMemoryTask(name, queue, payload, eta)
+            self._tasks.append(task)
+            return task
+
+    def tasks(self, queue_name=None, until=None):
+        """
+            Returns the queued tasks in the order of their ETA, optionally
+            filtered by queue and those due to run before `until`
+        """
+        until = _aware_eta(until)
+        with self._lock:
+            tasks = list(self._tasks)
+
+        return sorted(
+            [
+                x for x in tasks
+                if (queue_name is None or x.queue == queue_name) and (until is None or x.eta <= until)
+            ],
+            key=lambda x: x.eta
+        )
+
+    def purge(self, queue_name=None):
+        with self._lock:
+            self._tasks = [x for x in self._tasks if queue_name is not None and x.queue != queue_name]
+
+            # Forget task names too, so named tasks can be deferred again (e.g. by the next test)
+            if queue_name is None:
+                self._names = set()
+
+    def remove(self, task):
+        with self._lock:
+            if task in self._tasks:
+                self._tasks.remove(task)
+
+    def run_task(self, task):
+        """
+            Runs the task with the same semantics as the deferred handler, and returns the
+            status code the handler would, along with any exception raised. The task is
+            removed from the queue unless it needs to be retried.
+        """
+        from .deferred import PermanentTaskFailure, SingularTaskFailure
+
+        task.execution_count += 1
+        try:
+            _run_payload(task.payload, task.queue, task.name, task.execution_count - 1)
+        except SingularTaskFailure as e:
+            return 408, e
+        except PermanentTaskFailure:
+            logger.exception("Permanent failure attempting to execute task")
+        except Exception as e:
+            return 500, e
+
+        self.remove(task)
+        return 200, None
+
+
+def _freeze(value):
+    """ Returns a hashable equivalent of an option value, for the backend cache key """
+    if isinstance(value, dict):
+        return tuple(sorted((k, _freeze(v)) for k, v in value.items()))
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(x) for x in value)
+    if isinstance(value, (set, frozenset)):
+        return frozenset(_freeze(x) for x in value)
+
+    try:
+        hash(value)
+    except TypeError:
+        return repr(value)
+    return value
+
+
+def get_task_backend():
+    """
+        Returns the configured backend. Backends hold executors, so
+        the instance is shared for the lifetime of the process.
+    """
+    path = getattr(settings, _BACKEND_SETTING, _DEFAULT_BACKEND)
+    options = getattr(settings, _BACKEND_OPTIONS_SETTING, {})
+    key = (path, _freeze(options))
+
+    with _backends_lock:
+        if key not in _backends:
+            _backends[key] = import_string(path)(**options)
+        return _backends[key]
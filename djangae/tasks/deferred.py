@@ -9,26 +9,34 @@ it suffers from serious bugs, and "ticking timebomb" API decisions. Specifically
 
 This defer is an adapted version of that one, with the following changes:
 
-- defer() will *always* use an entity group (even if the task is < 100kb) unless you pass
-  _small_task=True
+- defer() will store the task in an entity group if it's too large to send with the task,
+  unless you pass _small_task=True
 - defer(_transactional=True) works
-- Adds a _wipe_related_caches option (defaults to True) which wipes out ForeignKey caches
-  if you defer Django model instances (which can result in stale data when the deferred task
-  runs)
+- Adds a _wipe_related_caches option (defaults to True) which leaves ForeignKey caches out
+  of the task if you defer Django model instances (which can result in stale data when the
+  deferred task runs)
 """
 
+import collections
+import contextlib
 import copy
 import functools
+import io
+import itertools
 import logging
 import pickle
 import threading
 import types
+import zlib
+from concurrent.futures import ThreadPoolExecutor
 from datetime import (
     datetime,
     timedelta,
 )
+from math import ceil
 from urllib.parse import unquote
 
+from django.apps import apps
 from django.conf import settings
 from django.db import (
     connections,
@@ -42,17 +50,29 @@ from google.api_core import exceptions
 from google.protobuf.timestamp_pb2 import Timestamp
 
 from djangae.environment import gae_version
-from djangae.models import DeferIterationMarker
+from djangae.models import (
+    DeferIterationMarker,
+    DeferIterationShard,
+)
 from djangae.processing import datastore_key_ranges
-from djangae.utils import retry
+from djangae.utils import (
+    iterate_in_batches,
+    retry,
+)
 
 from . import (
     CLOUD_TASKS_LOCATION_SETTING,
     cloud_tasks_project,
     get_cloud_tasks_client,
 )
+from .backends import (
+    _aware_eta,
+    get_task_backend,
+)
 from .environment import task_queue_name
+from .instrumentation import _callable_name
 from .models import DeferredTask
+from .payloads import get_payload_store
 
 logger = logging.getLogger(__name__)
 
@@ -72,10 +92,105 @@ _TASKQUEUE_HEADERS = {
 _CALLBACK_TIME_LIMIT_IN_SECONDS = 30
 _DEFERRED_SHARD_TIME_LIMIT_IN_SECONDS = (60 * 10) - _CALLBACK_TIME_LIMIT_IN_SECONDS
 
+# How many instances a shard processes between saving its progress
+_DEFAULT_CHECKPOINT_INTERVAL = 100
+
+# How many instances a shard fetches at a time (unless _batch_size is set)
+_DEFAULT_FETCH_SIZE = 100
+
+# When shard splitting is enabled, the default limit on the total number of
+# shards is this multiple of the number of shards requested
+_DEFAULT_MAX_SHARDS_MULTIPLIER = 4
+
+# How many DeferIterationShard entities are created in each batch
+_SHARD_CREATE_BATCH_SIZE = 500
+
+# How many key ranges a straggling shard asks the key ranges getter for when
+# choosing where to split its remaining range
+_SPLIT_SAMPLE_RANGES = 32
+
+# With _shards="auto", shard counts are chosen so that each shard processes around
+# this many instances, up to a ceiling of DJANGAE_DEFER_ITERATION_MAX_SHARDS or the
+# queue's "rate_max_concurrent" in CLOUD_TASKS_QUEUES (whichever is lower)
+_TARGET_SHARD_SIZE_SETTING = "DJANGAE_DEFER_ITERATION_TARGET_SHARD_SIZE"
+_MAX_SHARDS_SETTING = "DJANGAE_DEFER_ITERATION_MAX_SHARDS"
+_DEFAULT_TARGET_SHARD_SIZE = 10000
+_DEFAULT_MAX_SHARDS = 100
+
+# Counting for _shards="auto" reads at most this many keys, and querysets at least
+# this big use the maximum number of shards
+_AUTO_SHARD_COUNT_LIMIT_SETTING = "DJANGAE_DEFER_ITERATION_AUTO_COUNT_LIMIT"
+_DEFAULT_AUTO_SHARD_COUNT_LIMIT = 50000
+
+# The maximum number of Cloud Tasks submissions a batch() makes at once
+_BATCH_CONCURRENCY_SETTING = "DJANGAE_DEFERRED_BATCH_CONCURRENCY"
+_DEFAULT_BATCH_CONCURRENCY = 10
+
+# Task payloads larger than the threshold (in bytes) are compressed
+# with the configured codec ("zlib", "zstd" or None to disable)
+_COMPRESSION_SETTING = "DJANGAE_DEFERRED_COMPRESSION"
+_COMPRESSION_THRESHOLD_SETTING = "DJANGAE_DEFERRED_COMPRESSION_THRESHOLD"
+_DEFAULT_COMPRESSION = "zlib"
+_DEFAULT_COMPRESSION_THRESHOLD = 4 * 1024
+
+# Payloads larger than this (in bytes) are stored in the datastore rather than
+# sent with the task. App Engine tasks are limited to 100KB which includes the
+# headers and URL, so we leave a little headroom.
+_MAX_INLINE_TASK_SIZE_SETTING = "DJANGAE_DEFERRED_MAX_INLINE_TASK_SIZE"
+_DEFAULT_MAX_INLINE_TASK_SIZE = 95 * 1024
+
+# The default for defer(_instances_by_reference=)
+_INSTANCES_BY_REFERENCE_SETTING = "DJANGAE_DEFERRED_INSTANCES_BY_REFERENCE"
+
+# Payloads are wrapped in an envelope of:
+# _ENVELOPE_MAGIC + version byte + codec byte + data
+# Pickles always start with the PROTO opcode, so anything without the
+# magic prefix is treated as a raw pickle from before the envelope existed.
+_ENVELOPE_MAGIC = b"\x00DJ"
+_ENVELOPE_VERSION = 1
+
+_CODEC_NONE = 0
+_CODEC_ZLIB = 1
+_CODEC_ZSTD = 2
+
+_CODEC_IDS = {
+    None: _CODEC_NONE,
+    "zlib": _CODEC_ZLIB,
+    "zstd": _CODEC_ZSTD,
+}
+
 
 _local = threading.local()
 
 
+_stats_lock = threading.Lock()
+_stats = collections.Counter()
+
+
+def _increment_stats(**counts):
+    with _stats_lock:
+        _stats.update(counts)
+
+
+def deferred_stats():
+    """
+        Returns a dictionary of counters describing the tasks deferred
+        by this process.
+    """
+    with _stats_lock:
+        stats = dict(_stats)
+
+    if stats.get("compressed_bytes_in"):
+        stats["compression_ratio"] = stats["compressed_bytes_out"] / stats["compressed_bytes_in"]
+
+    return stats
+
+
+def reset_deferred_stats():
+    with _stats_lock:
+        _stats.clear()
+
+
 def get_deferred_shard_index():
     return getattr(_local, "shard_index", None)
 
@@ -96,34 +211,74 @@ class SingularTaskFailure(Error):
     """Indicates that a task failed once."""
 
 
+class BatchDeferError(Error):
+    """Indicates that one or more tasks in a batch could not be submitted."""
+
+    def __init__(self, results):
+        self.results = results
+        failed = [x for x in results if x.exception]
+        super().__init__(
+            "%s of %s deferred tasks failed to submit. First error was: %r" % (
+                len(failed), len(results), failed[0].exception
+            )
+        )
+
+
+def _run(data):
+    """
+        Unpickles and executes a task.
+    """
+    try:
+        func, args, kwds = _deserialize(data)
+    except Exception as e:
+        raise PermanentTaskFailure(e)
+    else:
+        return func(*args, **kwds)
+
+
 def _run_from_datastore(deferred_task_id):
     """
         Retrieves a task from the database and executes it.
-    """
 
-    def run(data):
-        """
-            Unpickles and executes a task.
-        """
-        try:
-            func, args, kwds = pickle.loads(data)
-        except Exception as e:
-            raise PermanentTaskFailure(e)
-        else:
-            return func(*args, **kwds)
+        Tasks are now stored via a PayloadStore and run with _run_from_store,
+        this remains for tasks which were queued before that.
+    """
 
     entity = DeferredTask.objects.filter(pk=deferred_task_id).first()
     if not entity:
         raise PermanentTaskFailure()
 
     try:
-        run(entity.data)
+        _run(entity.data)
         entity.delete()
     except PermanentTaskFailure:
         entity.delete()
         raise
 
 
+def _run_from_store(store, key, callable_name=None):
+    """
+        Retrieves a task from a payload store and executes it. `callable_name` is
+        the name of the task's callable, so that it can be reported without
+        fetching the payload.
+    """
+
+    data = store.get(key)
+    if data is None:
+        raise PermanentTaskFailure()
+
+    try:
+        _run(data)
+        store.release(key)
+    except PermanentTaskFailure:
+        store.release(key)
+        raise
+    except:  # noqa
+        # The task will be retried, so the payload mustn't be purged yet
+        store.touch(key)
+        raise
+
+
 def invoke_member(obj, membername, *args, **kwargs):
     return getattr(obj, membername)(*args, **kwargs)
 
@@ -154,34 +309,215 @@ def _curry_callable(obj, *args, **kwargs):
         raise ValueError("obj must be callable")
 
 
-def _wipe_caches(args, kwargs):
-    # Django related fields (E.g. foreign key) store a "cache" of the related
-    # object when it's first accessed. These caches can drastically bloat up
-    # an instance. If we then defer that instance we're pickling and unpickling a
-    # load of data we likely need to reload in the task anyway. This code
-    # wipes the caches of related fields if any of the args or kwargs are
-    # instances.
-    def _wipe_instance(instance):
-        for field in (f for f in instance._meta.fields if f.remote_field):
-            if field.is_cached(instance):
-                field.delete_cached_value(instance)
+class _DeferredPickler(pickle.Pickler):
+    """
+        Django related fields (E.g. foreign key) store a "cache" of the related
+        object when it's first accessed. These caches can drastically bloat up
+        an instance. If we then defer that instance we're pickling and unpickling a
+        load of data we likely need to reload in the task anyway. This pickler
+        leaves the related caches (and optionally the prefetch caches) of any model
+        instances out of the pickled data.
+
+        This is done when reducing the instance, so (unlike wiping the caches) we
+        don't need to copy the instance to avoid the calling code losing their
+        cached things.
+    """
+
+    def __init__(self, *args, wipe_related_caches=True, wipe_prefetch_caches=False, **kwargs):
+        self.wipe_related_caches = wipe_related_caches
+        self.wipe_prefetch_caches = wipe_prefetch_caches
+        super().__init__(*args, **kwargs)
+
+    def reducer_override(self, obj):
+        if not isinstance(obj, models.Model):
+            return NotImplemented
+
+        func, args, state = obj.__reduce__()
+
+        # Older versions of Django return the instance __dict__ itself
+        # from __getstate__, so we need to copy before changing anything
+        state = dict(state)
+
+        if self.wipe_related_caches and state["_state"].fields_cache:
+            model_state = copy.copy(state["_state"])
+            model_state.fields_cache = {}
+            state["_state"] = model_state
 
-    # We have to copy the instances before wiping the caches
-    # otherwise the calling code will suddenly lose their cached things
-    for i, arg in enumerate(args):
-        if isinstance(arg, models.Model):
-            args[i] = copy.deepcopy(arg)
-            _wipe_instance(args[i])
+        if self.wipe_prefetch_caches:
+            state.pop("_prefetched_objects_cache", None)
 
-    for k, v in list(kwargs.items()):
-        if isinstance(v, models.Model):
-            kwargs[k] = copy.deepcopy(v)
-            _wipe_instance(kwargs[k])
+        return func, args, state
+
+
+_ModelReference = collections.namedtuple("_ModelReference", "label pk using")
+
+
+def _reference_instances(args, kwargs):
+    """
+        Replaces any saved model instances in args and kwargs with a _ModelReference
+    """
+    def replace(value):
+        if isinstance(value, models.Model) and value.pk is not None:
+            return _ModelReference(value._meta.label_lower, value.pk, value._state.db)
+        return value
+
+    return (
+        tuple(replace(x) for x in args),
+        {k: replace(v) for k, v in kwargs.items()}
+    )
+
+
+def _call_with_instances(func, *args, **kwargs):
+    """
+        Reloads any instances referenced by _reference_instances, with a single query
+        per model, and then calls func with them.
+    """
+    references = collections.defaultdict(set)
+    for value in itertools.chain(args, kwargs.values()):
+        if isinstance(value, _ModelReference):
+            references[(value.label, value.using)].add(value.pk)
+
+    instances = {}
+    for (label, using), pks in references.items():
+        model = apps.get_model(label)
+        for pk, instance in model._default_manager.using(using).in_bulk(list(pks)).items():
+            instances[_ModelReference(label, pk, using)] = instance
+
+    def resolve(value):
+        if not isinstance(value, _ModelReference):
+            return value
+
+        try:
+            return instances[value]
+        except KeyError:
+            raise PermanentTaskFailure("%s with pk %r no longer exists" % (value.label, value.pk))
+
+    return func(
+        *[resolve(x) for x in args],
+        **{k: resolve(v) for k, v in kwargs.items()}
+    )
+
+
+def _compress(codec, data):
+    if codec == _CODEC_ZLIB:
+        return zlib.compress(data)
+    elif codec == _CODEC_ZSTD:
+        import zstandard
+        return zstandard.ZstdCompressor().compress(data)
+
+    return data
+
+
+def _decompress(codec, data):
+    if codec == _CODEC_NONE:
+        return data
+    elif codec == _CODEC_ZLIB:
+        return zlib.decompress(data)
+    elif codec == _CODEC_ZSTD:
+        try:
+            import zstandard
+        except ImportError:
+            raise PermanentTaskFailure("Task payload is zstd compressed, but zstandard is not installed")
+
+        return zstandard.ZstdDecompressor().decompress(data)
+
+    raise PermanentTaskFailure("Unknown task payload codec: %s" % codec)
+
+
+def _payload_codec():
+    name = getattr(settings, _COMPRESSION_SETTING, _DEFAULT_COMPRESSION)
+    if name not in _CODEC_IDS:
+        raise ValueError("%s must be one of %s" % (_COMPRESSION_SETTING, list(_CODEC_IDS)))
+
+    if name == "zstd":
+        try:
+            import zstandard  # noqa
+        except ImportError:
+            logger.warning("zstandard is not installed, falling back to zlib compression for deferred tasks")
+            name = "zlib"
+
+    return _CODEC_IDS[name]
+
+
+def _encode_payload(data):
+    """
+        Wraps pickled data in a versioned envelope, compressing it if
+        it is larger than DJANGAE_DEFERRED_COMPRESSION_THRESHOLD
+    """
+    codec = _CODEC_NONE
+    threshold = getattr(settings, _COMPRESSION_THRESHOLD_SETTING, _DEFAULT_COMPRESSION_THRESHOLD)
+
+    if len(data) > threshold:
+        codec = _payload_codec()
+
+    if codec != _CODEC_NONE:
+        compressed = _compress(codec, data)
+
+        _increment_stats(
+            compressed_tasks=1,
+            compressed_bytes_in=len(data),
+            compressed_bytes_out=len(compressed),
+        )
+
+        # No point storing it compressed if that didn't help
+        if len(compressed) < len(data):
+            data = compressed
+        else:
+            codec = _CODEC_NONE
+
+    return _ENVELOPE_MAGIC + bytes((_ENVELOPE_VERSION, codec)) + data
+
+
+def _decode_payload(payload):
+    """
+        Returns the pickled data from a task payload, payloads without an
+        envelope are returned as-is
+    """
+    payload = bytes(payload)
+
+    if not payload.startswith(_ENVELOPE_MAGIC):
+        return payload
+
+    header_length = len(_ENVELOPE_MAGIC) + 2
+    version, codec = payload[len(_ENVELOPE_MAGIC):header_length]
+
+    if version != _ENVELOPE_VERSION:
+        raise PermanentTaskFailure("Unsupported task payload version: %s" % version)
+
+    return _decompress(codec, payload[header_length:])
+
+
+def _dumps(curried, wipe_related_caches=False, wipe_prefetch_caches=False):
+    buffer = io.BytesIO()
+    _DeferredPickler(
+        buffer,
+        protocol=pickle.HIGHEST_PROTOCOL,
+        wipe_related_caches=wipe_related_caches,
+        wipe_prefetch_caches=wipe_prefetch_caches,
+    ).dump(curried)
+    return _encode_payload(buffer.getvalue())
 
 
 def _serialize(obj, *args, **kwargs):
-    curried = _curry_callable(obj, *args, **kwargs)
-    return pickle.dumps(curried, protocol=pickle.HIGHEST_PROTOCOL)
+    return _dumps(_curry_callable(obj, *args, **kwargs))
+
+
+def _deserialize(payload):
+    return pickle.loads(_decode_payload(payload))
+
+
+def _max_inline_task_size():
+    return getattr(settings, _MAX_INLINE_TASK_SIZE_SETTING, _DEFAULT_MAX_INLINE_TASK_SIZE)
+
+
+def _spill_payload(pickled_data, eta=None, callable_name=None):
+    """
+        Stores the payload of a task which will run at `eta` (or now) in the
+        payload store and returns the store, the key and a payload which will run it.
+    """
+    store = get_payload_store()
+    key = store.put(pickled_data, eta=eta)
+    return store, key, _serialize(_run_from_store, store, key, callable_name=callable_name)
 
 
 def _schedule_task(
@@ -190,20 +526,23 @@ def _schedule_task(
 ):
 
     client = get_cloud_tasks_client()
-    deferred_task = None
+    store = key = None
 
-    # Always use an entity group unless this has been
-    # explicitly marked as a small task
-    if not small_task:
-        deferred_task = DeferredTask.objects.create(data=pickled_data)
+    schedule_time = _aware_eta(task_args['eta'])
+    if task_args['countdown']:
+        schedule_time = timezone.now() + timedelta(seconds=task_args['countdown'])
+    eta = schedule_time
+
+    # Only store the payload elsewhere if it won't fit in the
+    # task itself (and this hasn't been marked as a small task)
+    if not small_task and len(pickled_data) > _max_inline_task_size():
+        store, key, body = _spill_payload(pickled_data, eta=eta, callable_name=task_args.get("callable_name"))
+    else:
+        body = pickled_data
 
     queue = queue or _DEFAULT_QUEUE
     path = client.queue_path(project_id, location, queue)
 
-    schedule_time = task_args['eta']
-    if task_args['countdown']:
-        schedule_time = timezone.now() + timedelta(seconds=task_args['countdown'])
-
     if schedule_time:
         # If a schedule time has bee requested, we need to convert
         # to a Timestamp
@@ -217,37 +556,56 @@ def _schedule_task(
         'app_engine_http_request': {  # Specify the type of request.
             'http_method': 'POST',
             'relative_uri': deferred_handler_url,
-            'body': pickled_data,
+            'body': body,
             'headers': task_headers,
             'app_engine_routing': task_args["routing"],
         }
     }
 
     try:
-        # Defer the task
-        task = client.create_task(path, task)  # FIXME: Handle transactional
-
-        # Delete the key as it wasn't needed
-        if deferred_task:
-            deferred_task.delete()
-    except exceptions.InvalidArgument as e:
-        if "Task size too large" not in str(e):
-            raise
+        try:
+            # Defer the task
+            created = client.create_task(path, task)  # FIXME: Handle transactional
+        except exceptions.InvalidArgument as e:
+            if "Task size too large" not in str(e):
+                raise
 
-        if small_task:
-            raise
+            if small_task or store:
+                raise
 
-        # Replace the task body with one containing a function to run the
-        # original task body which is stored in the datastore entity.
-        task["body"] = _serialize(_run_from_datastore, deferred_task.pk)
+            # The size limit must be lower than we thought. Replace the task body with
+            # one containing a function to run the original task body which is stored
+            # in the payload store.
+            logger.warning(
+                "Task of %s bytes was too large to submit inline, consider lowering %s",
+                len(pickled_data), _MAX_INLINE_TASK_SIZE_SETTING
+            )
+            store, key, task['app_engine_http_request']['body'] = _spill_payload(
+                pickled_data, eta=eta, callable_name=task_args.get("callable_name")
+            )
 
-        client.create_task(path, task)  # FIXME: Handle transactional
+            created = client.create_task(path, task)  # FIXME: Handle transactional
     except:  # noqa
-        # Any other exception? Delete the key
-        if deferred_task:
-            deferred_task.delete()
+        # Any exception? Release the payload
+        if store:
+            store.release(key)
         raise
 
+    if store:
+        _increment_stats(spilled_tasks=1)
+    else:
+        _increment_stats(inline_tasks=1)
+
+    return created
+
+
+def _enqueue_task(*args):
+    """
+        Submits a task to the configured backend, which is
+        Cloud Tasks unless settings.DJANGAE_DEFERRED_BACKEND is set
+    """
+    return get_task_backend().schedule(*args)
+
 
 def defer(obj, *args, **kwargs):
     """
@@ -259,8 +617,9 @@ def defer(obj, *args, **kwargs):
         run on successful commit, but they're not *guaranteed* to run if there is an error
         submitting them.
 
-        It also *always* uses an entity group, unless you pass _small_task=True in which
-        case it *never* uses an entity group (but you are limited by 100K)
+        If the task payload is too large to send inline it is stored in an entity group, unless
+        you pass _small_task=True in which case it *never* uses an entity group (but you are
+        limited by 100K)
 
         :param _service: the GAE service to route the task to
         :type _service: str, optional
@@ -269,6 +628,9 @@ def defer(obj, *args, **kwargs):
         :type _version: str, optional
         :param _instance: the GAE instance to route the task to
         :type _instance: str, optional
+        :param _instances_by_reference: pass saved model instances as a reference which
+            is reloaded when the task runs, rather than pickling them
+        :type _instances_by_reference: bool, optional
     """
 
     KWARGS = {
@@ -297,6 +659,11 @@ def defer(obj, *args, **kwargs):
 
     small_task = kwargs.pop("_small_task", False)
     wipe_related_caches = kwargs.pop("_wipe_related_caches", True)
+    wipe_prefetch_caches = kwargs.pop("_wipe_prefetch_caches", False)
+    instances_by_reference = kwargs.pop(
+        "_instances_by_reference",
+        getattr(settings, _INSTANCES_BY_REFERENCE_SETTING, False)
+    )
 
     task_headers = dict(_TASKQUEUE_HEADERS)
     task_headers.update(kwargs.pop("_headers", {}))
@@ -315,12 +682,24 @@ def defer(obj, *args, **kwargs):
     # So we can pass through to the schedule function
     task_args["routing"] = routing
 
-    if wipe_related_caches:
-        args = list(args)
-        _wipe_caches(args, kwargs)
-        args = tuple(args)
+    if instances_by_reference:
+        # Saved instances are replaced with a reference which is reloaded when the
+        # task runs, so there's no need to pickle them at all
+        func, args, kwargs = _curry_callable(obj, *args, **kwargs)
+        args, kwargs = _reference_instances(args, kwargs)
+        obj, args, kwargs = _call_with_instances, (func,) + args, kwargs
 
-    pickled = _serialize(obj, *args, **kwargs)
+    curried = _curry_callable(obj, *args, **kwargs)
+
+    # Payloads which are too large to send with the task are run by _run_from_store,
+    # which is passed this so the task is still reported under its own name
+    task_args["callable_name"] = _callable_name(curried[0], curried[1])
+
+    pickled = _dumps(
+        curried,
+        wipe_related_caches=wipe_related_caches,
+        wipe_prefetch_caches=wipe_prefetch_caches,
+    )
 
     project_id = cloud_tasks_project()
     assert(project_id)  # Should be checked in apps.py ready()
@@ -330,12 +709,188 @@ def defer(obj, *args, **kwargs):
 
     args = (project_id, location, queue, pickled, task_args, small_task, deferred_handler_url, task_headers)
 
-    if transactional:
+    current_batch = _current_batch()
+    if current_batch:
+        current_batch._add(connection, transactional, args)
+    elif transactional:
         # Django connections have an on_commit message that run things on
         # post-commit.
-        connection.on_commit(functools.partial(_schedule_task, *args))
+        connection.on_commit(functools.partial(_enqueue_task, *args))
     else:
-        _schedule_task(*args)
+        return _enqueue_task(*args)
+
+
+class DeferredTaskResult:
+    """
+        The outcome of submitting a single task as part of a batch. `task` is the
+        value returned by Cloud Tasks, `exception` is set if the submission failed.
+    """
+
+    def __init__(self, schedule_args, task=None, exception=None):
+        self.schedule_args = schedule_args
+        self.task = task
+        self.exception = exception
+
+    @property
+    def queue(self):
+        return self.schedule_args[2]
+
+    @property
+    def succeeded(self):
+        return self.exception is None
+
+    def __repr__(self):
+        return "<DeferredTaskResult queue=%s succeeded=%s>" % (self.queue, self.succeeded)
+
+
+def _batch_concurrency():
+    return getattr(settings, _BATCH_CONCURRENCY_SETTING, _DEFAULT_BATCH_CONCURRENCY)
+
+
+class DeferredBatch:
+    """
+        Collects calls to defer() and submits them to Cloud Tasks concurrently on
+        a bounded thread pool, rather than making one blocking round trip per task.
+
+        Use via the `batch()` context manager or `defer_many()`.
+    """
+
+    def __init__(self, concurrency=None, raise_errors=True):
+        self.concurrency = max(1, concurrency or _batch_concurrency())
+        self.raise_errors = raise_errors
+        self.results = []
+
+        self._pending = []
+
+        # Transactional tasks are moved here by an on_commit hook once their
+        # transaction has committed, they are then submitted together
+        self._committed = []
+        self._connections = set()
+
+    def _add(self, connection, transactional, schedule_args):
+        if transactional:
+            self._connections.add(connection.alias)
+            connection.on_commit(functools.partial(self._committed.append, schedule_args))
+        else:
+            self._pending.append(schedule_args)
+
+    def _submit_one(self, schedule_args):
+        try:
+            return DeferredTaskResult(schedule_args, task=_enqueue_task(*schedule_args))
+        except Exception as e:
+            logger.exception("Error submitting deferred task as part of a batch")
+            return DeferredTaskResult(schedule_args, exception=e)
+
+    def _submit_in_thread(self, schedule_args):
+        try:
+            return self._submit_one(schedule_args)
+        finally:
+            # Each worker thread gets its own database connections, make sure we
+            # don't leak them. This mustn't happen on the calling thread, where it
+            # would close connections (and transactions) that are still in use.
+            connections.close_all()
+
+    def _submit(self, to_submit):
+        if not to_submit:
+            return []
+
+        if len(to_submit) == 1:
+            results = [self._submit_one(to_submit[0])]
+        else:
+            workers = min(self.concurrency, len(to_submit))
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                results = list(executor.map(self._submit_in_thread, to_submit))
+
+        self.results.extend(results)
+
+        if self.raise_errors and any(x.exception for x in results):
+            raise BatchDeferError(results)
+
+        return results
+
+    def _flush_committed(self):
+        to_submit, self._committed[:] = list(self._committed), []
+        return self._submit(to_submit)
+
+    def flush(self):
+        """
+            Submits everything that is ready to go. Transactional tasks whose
+            transaction hasn't committed yet are submitted together in a single
+            on_commit hook.
+        """
+        to_submit = self._pending + self._committed
+        self._pending = []
+        self._committed[:] = []
+
+        for alias in self._connections:
+            connection = connections[alias]
+            if connection.in_atomic_block:
+                connection.on_commit(self._flush_committed)
+
+        self._connections = set()
+
+        return self._submit(to_submit)
+
+
+def _current_batch():
+    stack = getattr(_local, "batches", None)
+    return stack[-1] if stack else None
+
+
+@contextlib.contextmanager
+def batch(concurrency=None, raise_errors=True):
+    """
+        Context manager which collects any calls to defer() made inside it and
+        submits them concurrently when the block exits:
+
+            with batch() as b:
+                for instance in queryset:
+                    defer(do_something, instance.pk)
+
+            b.results  # A list of DeferredTaskResult
+
+        `concurrency` is the maximum number of simultaneous submissions, defaulting to
+        settings.DJANGAE_DEFERRED_BATCH_CONCURRENCY (or 10). If `raise_errors` is True a
+        BatchDeferError is raised if any task failed to submit, the other tasks will
+        still have been submitted.
+
+        Transactional tasks are held until their transaction commits and then submitted
+        as a single batch. If that happens after the block exits their results are
+        added to `results` at that point.
+    """
+
+    current = DeferredBatch(concurrency=concurrency, raise_errors=raise_errors)
+
+    if not hasattr(_local, "batches"):
+        _local.batches = []
+
+    _local.batches.append(current)
+    try:
+        yield current
+    except:  # noqa
+        # Something went wrong, don't submit anything
+        _local.batches.pop()
+        raise
+    else:
+        _local.batches.pop()
+        current.flush()
+
+
+def defer_many(tasks, _concurrency=None, _raise_errors=True):
+    """
+        Defers a number of tasks at once, submitting them concurrently. `tasks` is an iterable
+        of (callable, args, kwargs) tuples, the args and kwargs are passed to defer() so
+        can include any of its options (e.g. `_queue`).
+
+        Returns a list of DeferredTaskResult, one for each task submitted.
+    """
+
+    with batch(concurrency=_concurrency, raise_errors=_raise_errors) as current:
+        for task in tasks:
+            obj, args, kwargs = (tuple(task) + ((), {}))[:3]
+            defer(obj, *args, **kwargs)
+
+    return current.results
 
 
 class TimeoutException(Exception):
@@ -343,8 +898,164 @@ class TimeoutException(Exception):
     pass
 
 
-def _process_shard(marker_id, shard_number, model, query, callback, finalize, args, kwargs):
+def _mapped_values(values):
+    """
+        Returns a list of the values returned (or yielded) by a
+        defer_iteration_with_reduce callback, None means no value
+    """
+    if values is None:
+        return []
+
+    if isinstance(values, types.GeneratorType):
+        return list(values)
+
+    return [values]
+
+
+def _project(queryset, options):
+    """
+        Applies the _only, _values or _keys_only options to a shard's queryset. Returns
+        the queryset, and a function which returns the primary key of one of its rows.
+    """
+    if options.get("keys_only"):
+        return queryset.values_list("pk", flat=True), (lambda row: row)
+
+    if options.get("values"):
+        fields = [x for x in options["values"] if x != "pk"]
+        return queryset.values_list("pk", *fields, named=True), (lambda row: row.pk)
+
+    if options.get("only"):
+        queryset = queryset.only(*options["only"])
+
+    return queryset, (lambda row: row.pk)
+
+
+def _iterate_batches(queryset, batch_size, prefetch, key=None):
+    """
+        Yields lists of `batch_size` instances, or lists of a single instance
+        if batch_size is None
+    """
+    if batch_size:
+        yield from iterate_in_batches(queryset, batch_size=batch_size, prefetch=prefetch, key=key)
+        return
+
+    for page in iterate_in_batches(queryset, batch_size=_DEFAULT_FETCH_SIZE, prefetch=prefetch, key=key):
+        for instance in page:
+            yield [instance]
+
+
+def _find_split_key(queryset, key_ranges_getter):
+    """
+        Returns a key roughly half way through the instances in queryset,
+        or None if there isn't one worth splitting at
+    """
+    first_pk = queryset.order_by("pk").values_list("pk", flat=True).first()
+    last_pk = queryset.order_by("-pk").values_list("pk", flat=True).first()
+    if first_pk is None or first_pk == last_pk:
+        return None
+
+    # Key range getters (e.g. datastore_key_ranges) may sample keys from outside
+    # the queryset, so only boundaries within what's left are used. Both halves
+    # are left with at least one instance.
+    boundaries = sorted({
+        start for start, end in key_ranges_getter(queryset, _SPLIT_SAMPLE_RANGES)
+        if start is not None and first_pk < start <= last_pk
+    })
+    if not boundaries:
+        return None
+
+    return boundaries[len(boundaries) // 2]
+
+
+def _split_shard(
+    marker, checkpoint, model, query, callback, finalize, args, kwargs, options, queue, after_key=None
+):
+    """
+        Splits the unprocessed part of a shard's range in two, and defers a new
+        shard to process the second half. Returns True if the shard was split.
+
+        `after_key` is the last key which has been (or is being) processed, which
+        defaults to the last key in the checkpoint.
+    """
+    remaining = model.objects.all()
+    remaining.query = query
+
+    if after_key is None:
+        after_key = checkpoint.last_key
+
+    if after_key is not None:
+        remaining = remaining.filter(pk__gt=after_key)
+
+    end_key = checkpoint.end_key
+    if end_key is not None:
+        remaining = remaining.filter(pk__lt=end_key)
+
+    split_key = _find_split_key(remaining, options["key_ranges_getter"])
+    if split_key is None:
+        return False
+
+    qs = model.objects.all()
+    qs.query = query
+    qs = qs.filter(pk__gte=split_key)
+
+    @transaction.atomic(xg=True)
+    def split():
+        marker.refresh_from_db()
+
+        # The new shard's (incomplete) entity is created before this shard can complete,
+        # so the finalize still waits for it. The marker is only written here to
+        # allocate a shard number, which is rare.
+        if marker.shard_count >= options["max_shards"]:
+            return False
+
+        shard_number = marker.shard_count
+        marker.shard_count += 1
+        marker.save()
+
+        checkpoint.end_key = split_key
+        checkpoint.save()
+
+        new_checkpoint = DeferIterationShard(
+            pk=DeferIterationShard.make_id(marker.pk, shard_number),
+            marker_id=marker.pk,
+            shard_number=shard_number,
+        )
+        new_checkpoint.end_key = end_key
+        new_checkpoint.save()
+
+        defer(
+            _process_shard,
+            marker.pk,
+            shard_number,
+            qs.model, qs.query, callback, finalize,
+            args=args,
+            kwargs=kwargs,
+            options=options,
+            _queue=queue,
+            _transactional=True
+        )
+        return True
+
+    was_split = False
+    try:
+        was_split = retry(split, _attempts=5)
+    finally:
+        if not was_split:
+            # An attempt may have narrowed this shard's range before its commit
+            # failed, and this shard must still process up to the original end
+            checkpoint.end_key = end_key
+
+    if was_split:
+        logger.debug("Split shard %s of %s at key %s", checkpoint.shard_number, marker.pk, split_key)
+    return was_split
+
+
+def _process_shard(marker_id, shard_number, model, query, callback, finalize, args, kwargs, options=None):
     args = args or tuple()
+    options = options or {}
+
+    # If a batch size was specified, the callback receives a list of instances
+    batch_size = options.get("batch_size")
 
     # Set an index of the shard in the environment, which is useful for callbacks
     # to have access too so they can identify a task
@@ -368,6 +1079,7 @@ def _process_shard(marker_id, shard_number, model, query, callback, finalize, ar
             _process_shard, marker_id, shard_number, model, query, callback, finalize,
             args=args,
             kwargs=kwargs,
+            options=options,
             _queue=queue,
             _countdown=1
         )
@@ -375,156 +1087,451 @@ def _process_shard(marker_id, shard_number, model, query, callback, finalize, ar
 
     first_iteration = True
 
+    # Progress is saved to the checkpoint every `checkpoint_interval` instances, so if
+    # the task is retried (or dies) we resume after the last instance which was saved
+    checkpoint = DeferIterationShard.for_shard(marker_id, shard_number)
+    checkpoint_interval = options.get("checkpoint_interval") or _DEFAULT_CHECKPOINT_INTERVAL
+    unsaved_count = 0
+
+    if checkpoint.started is None:
+        checkpoint.started = timezone.now()
+
+    last_saved = start_time
+
+    # With defer_iteration_with_reduce, callbacks return values which are combined into a
+    # partial result for the shard. It's saved with the checkpoint, so retries carry on with it.
+    reduce_functions = options.get("reduce")
+    result = None
+    if reduce_functions:
+        result = copy.deepcopy(reduce_functions[2]) if checkpoint.result_data is None else checkpoint.result
+
+    def sync_result():
+        if reduce_functions:
+            checkpoint.result = result
+
+    def save_checkpoint():
+        nonlocal last_saved, unsaved_count
+
+        sync_result()
+        now = datetime.now()
+        checkpoint.elapsed += (now - last_saved).total_seconds()
+        checkpoint.save()
+        last_saved = now
+        unsaved_count = 0
+
+    split_attempted = False
+
+    def maybe_split(timed_out=False):
+        # If other shards have finished (or we've run out of time) then this shard is
+        # behind, so hand half of what's left to a new shard. Finding a split key samples
+        # the remaining keys, so we only try once per task.
+        nonlocal split_attempted
+
+        if not options.get("split_shards") or split_attempted:
+            return
+
+        marker.refresh_from_db()
+        if marker.shard_count >= options["max_shards"]:
+            return
+
+        if timed_out or DeferIterationShard.objects.filter(
+            marker_id=marker_id, completed__isnull=False
+        ).exists():
+            # Callbacks may already be running past the checkpoint, so split after those
+            split_attempted = True
+            sync_result()
+            _split_shard(
+                marker, checkpoint, model, query, callback, finalize, args, kwargs, options, queue,
+                after_key=dispatched_key,
+            )
+
+    def run_callback(batch):
+        callback_start = datetime.now()
+        values = callback(batch if batch_size else batch[0], *args, **kwargs)
+        if reduce_functions:
+            values = _mapped_values(values)
+        callback_end = datetime.now()
+
+        callback_time = (callback_end - callback_start).total_seconds()
+        if callback_time > _CALLBACK_TIME_LIMIT_IN_SECONDS:
+            logging.warning(
+                "Detected slow callback function (>%ss) during iteration, this could result in failed tasks",
+                callback_time
+            )
+
+        return values
+
+    def run_callback_in_thread(batch):
+        _set_deferred_shard_index(shard_number)
+        try:
+            return run_callback(batch)
+        finally:
+            _set_deferred_shard_index(None)
+
+            # Each worker thread gets its own database connections, make
+            # sure we don't leak them
+            connections.close_all()
+
+    def record_progress(batch, values):
+        nonlocal first_iteration, unsaved_count, result
+
+        first_iteration = False
+
+        if reduce_functions:
+            combiner = reduce_functions[0]
+            for value in values:
+                result = combiner(result, value)
+
+        checkpoint.last_key = row_key(batch[-1])
+        checkpoint.processed_count += len(batch)
+        unsaved_count += len(batch)
+        if unsaved_count >= checkpoint_interval:
+            save_checkpoint()
+            maybe_split()
+
+    # With _concurrency, callbacks run on a pool of threads. Running callbacks are kept in
+    # the order they were dispatched, and are only recorded in the checkpoint once all of
+    # the callbacks before them have finished, so the checkpoint never skips past an
+    # instance which hasn't been processed.
+    concurrency = options.get("concurrency") or 1
+    executor = ThreadPoolExecutor(max_workers=concurrency) if concurrency > 1 else None
+    running = collections.deque()
+    dispatched_key = None
+
+    def record_finished(wait=False):
+        while running and (wait or running[0][1].done() or len(running) > concurrency * 2):
+            batch, future = running[0]
+            values = future.result()  # Leaves a failed callback at the front, so nothing after it is recorded
+            running.popleft()
+            record_progress(batch, values)
+
+    batches = None
+
     try:
         qs = model.objects.all()
         qs.query = query
 
-        last_pk = None
-        for instance in qs.order_by("pk"):
-            last_pk = instance.pk
+        if checkpoint.last_key is not None:
+            qs = qs.filter(pk__gt=checkpoint.last_key)
+
+        if checkpoint.end_key is not None:
+            qs = qs.filter(pk__lt=checkpoint.end_key)
 
+        qs, row_key = _project(qs.order_by("pk"), options)
+        batches = _iterate_batches(qs, batch_size, options.get("prefetch") or 0, key=row_key)
+        for batch in batches:
             shard_time = (datetime.now() - start_time).total_seconds()
             if shard_time > _DEFERRED_SHARD_TIME_LIMIT_IN_SECONDS:
                 raise TimeoutException()
 
-            callback_start = datetime.now()
-            callback(instance, *args, **kwargs)
-            callback_end = datetime.now()
+            # The end of the range may have been split off while this batch was fetched
+            end_key = checkpoint.end_key
+            reached_end = end_key is not None and row_key(batch[-1]) >= end_key
+            if reached_end:
+                batch = [x for x in batch if row_key(x) < end_key]
+                if not batch:
+                    break
 
-            callback_time = (callback_end - callback_start).total_seconds()
+            dispatched_key = row_key(batch[-1])
+            if executor:
+                running.append((batch, executor.submit(run_callback_in_thread, batch)))
+                record_finished()
+            else:
+                record_progress(batch, run_callback(batch))
 
-            first_iteration = False
+            if reached_end:
+                break
 
-            if callback_time > _CALLBACK_TIME_LIMIT_IN_SECONDS:
-                logging.warning(
-                    "Detected slow callback function (>%ss) during iteration, this could result in failed tasks",
-                    callback_time
-                )
-        else:
-            @transaction.atomic(xg=True)
-            def mark_shard_complete():
-                try:
-                    marker.refresh_from_db()
-                except DeferIterationMarker.DoesNotExist:
-                    logger.warning(
-                        "TaskMarker with ID: %s has vanished, cancelling task",
-                        marker_id
-                    )
-                    return
-
-                marker.shards_complete += 1
-                marker.save()
-
-                if marker.shards_complete == marker.shard_count:
-                    # Delete the marker if we were asked to
-                    if marker.delete_on_completion:
-                        marker.delete()
-
-                    defer(
-                        finalize,
-                        *args,
-                        _transactional=True,
-                        _queue=queue,
-                        **kwargs
-                    )
-            retry(mark_shard_complete, _attempts=6)
+        record_finished(wait=True)
+
+        sync_result()
+        checkpoint.elapsed += (datetime.now() - last_saved).total_seconds()
+        checkpoint.completed = timezone.now()
+
+        # Each shard only writes its own entity when it completes, the marker is only
+        # written (by whichever shards notice that they were the last to finish) to make
+        # sure the finalize is deferred once
+        retry(checkpoint.save, _attempts=6)
+
+        if _all_shards_complete(marker_id):
+            _queue_finalize(marker_id, finalize, args, kwargs, queue, reducer=reduce_functions and reduce_functions[1])
 
     except (Exception, TimeoutException) as e:
         # If we get any kind of exception, we want to redefer from where we got to, and we'll keep doing
         # that until the developer deploys a fix.
+        try:
+            # Record whatever finished before the first callback which failed, or is still running
+            record_finished(wait=True)
+        except Exception:
+            pass
+
+        if unsaved_count:
+            save_checkpoint()
+
         if isinstance(e, TimeoutException):
             logger.debug(
-                "Ran out of time processing shard. Deferring new shard to continue from: %s",
-                last_pk
+                "Ran out of time processing shard. Deferring new shard to continue after: %s",
+                checkpoint.last_key
             )
+            try:
+                maybe_split(timed_out=True)
+            except Exception:
+                logger.exception("Unable to split shard, continuing with the whole range")
         else:
             logger.exception("Error processing shard. Retrying.")
 
             if first_iteration:
                 # If this is the first iteration, we just re-raise to show that this
-                # is an error-case. We can't do that if it's not the first iteration
-                # because that would mean retrying the previous instances again
+                # is an error-case. The retry will continue from the checkpoint.
                 raise
 
-        if last_pk:
-            qs = qs.filter(pk__gte=last_pk)
-
+        # The new shard picks up the checkpoint, so we pass the original query
         defer(
-            _process_shard, marker_id, shard_number, qs.model, qs.query, callback, finalize,
+            _process_shard, marker_id, shard_number, model, query, callback, finalize,
             args=args,
             kwargs=kwargs,
+            options=options,
             _queue=queue,
             _countdown=1
         )
     finally:
+        if executor:
+            executor.shutdown(wait=True)
+        if batches is not None:
+            batches.close()
         _set_deferred_shard_index(None)
 
 
+def _max_auto_shards(queue):
+    """
+        Returns the most shards that _shards="auto" will use on the queue. There's
+        no point having more shards than the queue will run at once.
+    """
+    ceiling = getattr(settings, _MAX_SHARDS_SETTING, _DEFAULT_MAX_SHARDS)
+
+    for config in getattr(settings, "CLOUD_TASKS_QUEUES", []):
+        if config["name"] == (queue or _DEFAULT_QUEUE) and config.get("rate_max_concurrent"):
+            ceiling = min(ceiling, config["rate_max_concurrent"])
+
+    return max(ceiling, 1)
+
+
+def _auto_shard_count(queryset, queue, total=None, throughput=None):
+    """
+        Picks a shard count for the queryset so that each shard processes around
+        DJANGAE_DEFER_ITERATION_TARGET_SHARD_SIZE instances. If `throughput` (instances
+        per second for a single shard) is known, then shards are also kept small
+        enough to finish within a single task.
+
+        If `total` isn't passed the queryset is counted, but the count stops at
+        DJANGAE_DEFER_ITERATION_AUTO_COUNT_LIMIT instances (and then the maximum
+        number of shards is used).
+    """
+    max_shards = _max_auto_shards(queue)
+
+    shard_size = getattr(settings, _TARGET_SHARD_SIZE_SETTING, _DEFAULT_TARGET_SHARD_SIZE)
+    if throughput:
+        shard_size = min(shard_size, int(throughput * _DEFERRED_SHARD_TIME_LIMIT_IN_SECONDS))
+    shard_size = max(shard_size, 1)
+
+    if total is None:
+        limit = getattr(settings, _AUTO_SHARD_COUNT_LIMIT_SETTING, _DEFAULT_AUTO_SHARD_COUNT_LIMIT)
+        limit = max(min(limit, max_shards * shard_size), 1)
+
+        total = queryset[:limit].count()
+        if total >= limit:
+            return max_shards
+
+    return min(max(ceil(total / shard_size), 1), max_shards)
+
+
+def _all_shards_complete(marker_id):
+    """
+        Called when a shard completes, returns True if every shard of the iteration
+        has completed. Shards are fetched by key (rather than queried) so that we
+        see shards which completed at the same time.
+    """
+    try:
+        marker = DeferIterationMarker.objects.get(pk=marker_id)
+    except DeferIterationMarker.DoesNotExist:
+        logger.warning("DeferIterationMarker with ID: %s has vanished, cancelling task", marker_id)
+        return False
+
+    shard_ids = [DeferIterationShard.make_id(marker_id, x) for x in range(marker.shard_count)]
+    shards = {}
+    for i in range(0, len(shard_ids), _SHARD_CREATE_BATCH_SIZE):
+        shards.update(DeferIterationShard.objects.in_bulk(shard_ids[i:i + _SHARD_CREATE_BATCH_SIZE]))
+
+    if len(shards) == len(shard_ids):
+        return all(x.completed is not None for x in shards.values())
+
+    # This iteration started before shards had their own entities, so shards which
+    # completed before then were only counted on the marker
+    @transaction.atomic(xg=True)
+    def count_complete():
+        try:
+            marker.refresh_from_db()
+        except DeferIterationMarker.DoesNotExist:
+            return False
+
+        marker.shards_complete += 1
+        marker.save()
+        return marker.shards_complete >= marker.shard_count
+
+    return retry(count_complete, _attempts=6)
+
+
+def _queue_finalize(marker_id, finalize, args, kwargs, queue, reducer=None):
+    """
+        Defers the finalize for an iteration, unless another shard already did. If
+        there's a reducer, the shards' results are reduced and passed to the finalize.
+    """
+    if reducer:
+        shards = DeferIterationShard.objects.filter(marker_id=marker_id).order_by("shard_number")
+        args = (functools.reduce(reducer, [x.result for x in shards]),) + tuple(args)
+
+    @transaction.atomic(xg=True)
+    def claim_finalize():
+        try:
+            marker = DeferIterationMarker.objects.get(pk=marker_id)
+        except DeferIterationMarker.DoesNotExist:
+            logger.warning("DeferIterationMarker with ID: %s has vanished, cancelling task", marker_id)
+            return False
+
+        if marker.finalize_queued:
+            return False
+
+        marker.finalize_queued = True
+        marker.shards_complete = marker.shard_count
+
+        # Delete the marker if we were asked to
+        if marker.delete_on_completion:
+            marker.delete()
+        else:
+            marker.save()
+
+        defer(
+            finalize,
+            *args,
+            _transactional=True,
+            _queue=queue,
+            **kwargs
+        )
+        return marker.delete_on_completion
+
+    if retry(claim_finalize, _attempts=6):
+        # The shard checkpoints are only cleaned up once the marker is gone, and
+        # outside the transaction because it needs a query
+        DeferIterationShard.objects.filter(marker_id=marker_id).delete()
+
+
 def _generate_shards(
-    model, query, callback, finalize, args, kwargs, shards, delete_marker, key_ranges_getter
+    model, query, callback, finalize, args, kwargs, shards, delete_marker, key_ranges_getter, options=None
 ):
 
     queryset = model.objects.all()
     queryset.query = query
 
+    options = options or {}
+    queue = task_queue_name()
+    if queue:
+        queue = queue.rsplit("/", 1)[-1]
+
+    # Counting is a keys-only query, but it still has to visit every key so it's opt-in
+    estimated_total = queryset.count() if options.get("estimate_total") else None
+
+    if shards == "auto":
+        shards = _auto_shard_count(
+            queryset, queue, total=estimated_total, throughput=options.get("shard_throughput")
+        )
+
+    if not options.get("max_shards"):
+        options["max_shards"] = shards * _DEFAULT_MAX_SHARDS_MULTIPLIER
+
     key_ranges = key_ranges_getter(queryset, shards)
 
+    # Some getters (e.g. quantile_key_ranges) know how many instances are in each range
+    populations = getattr(key_ranges, "populations", None) or [None] * len(key_ranges)
+    if estimated_total is None and None not in populations:
+        estimated_total = sum(populations)
+
     marker = DeferIterationMarker.objects.create(
+        shard_count=len(key_ranges),
+        estimated_total=estimated_total,
         delete_on_completion=delete_marker,
         callback_name=callback.__name__,
         finalize_name=finalize.__name__
     )
 
-    queue = task_queue_name()
-    if queue:
-        queue = queue.rsplit("/", 1)[-1]
-
-    for i, (start, end) in enumerate(key_ranges):
-        is_last = i == (len(key_ranges) - 1)
-        shard_number = i
-
+    tasks = []
+    for shard_number, (start, end) in enumerate(key_ranges):
         qs = model.objects.all()
         qs.query = query
 
         filter_kwargs = {}
-        if start:
+        if start is not None:
             filter_kwargs["pk__gte"] = start
 
-        if end:
+        if end is not None:
             filter_kwargs["pk__lt"] = end
 
         qs = qs.filter(**filter_kwargs)
 
-        @transaction.atomic(xg=True)
-        def make_shard():
-            marker.refresh_from_db()
-            marker.shard_count += 1
-            if is_last:
-                marker.is_ready = True
-            marker.save()
+        tasks.append((
+            _process_shard,
+            (marker.pk, shard_number, qs.model, qs.query, callback, finalize),
+            dict(args=args, kwargs=kwargs, options=options, _queue=queue),
+        ))
 
-            defer(
-                _process_shard,
-                marker.pk,
-                shard_number,
-                qs.model, qs.query, callback, finalize,
-                args=args,
-                kwargs=kwargs,
-                _queue=queue,
-                _transactional=True
+    try:
+        # Shards know they're complete once none of these are left incomplete, so they must
+        # all exist before any shard can start (which they won't until the marker is ready)
+        DeferIterationShard.objects.bulk_create([
+            DeferIterationShard(
+                pk=DeferIterationShard.make_id(marker.pk, shard_number),
+                marker_id=marker.pk,
+                shard_number=shard_number,
+                estimated_count=populations[shard_number],
             )
+            for shard_number in range(len(key_ranges))
+        ], batch_size=_SHARD_CREATE_BATCH_SIZE)
 
-        try:
-            retry(make_shard, _attempts=5)
-        except:  # noqa
-            marker.delete()  # This will cause outstanding tasks to abort
-            raise
+        defer_many(tasks)
+
+        marker.is_ready = True
+        retry(marker.save, _attempts=5)
+    except:  # noqa
+        marker.delete()  # This will cause outstanding tasks to abort
+        raise
 
 
 def defer_iteration_with_finalize(
         queryset, callback, finalize, key_ranges_getter=datastore_key_ranges, _queue='default', _shards=5,
         _delete_marker=True, _transactional=False, *args, **kwargs):
 
+    options = {
+        "batch_size": kwargs.pop("_batch_size", None),
+        "checkpoint_interval": kwargs.pop("_checkpoint_interval", None),
+        "prefetch": kwargs.pop("_prefetch", 0),
+        "split_shards": kwargs.pop("_split_shards", False),
+        "max_shards": kwargs.pop("_max_shards", None),
+        "estimate_total": kwargs.pop("_estimate_total", False),
+        "shard_throughput": kwargs.pop("_shard_throughput", None),
+        "concurrency": kwargs.pop("_concurrency", None),
+        # (combiner, reducer, initial), set by defer_iteration_with_reduce
+        "reduce": kwargs.pop("_reduce", None),
+        "only": kwargs.pop("_only", None),
+        "values": kwargs.pop("_values", None),
+        "keys_only": kwargs.pop("_keys_only", False),
+    }
+
+    if len([x for x in ("only", "values", "keys_only") if options[x]]) > 1:
+        raise ValueError("Only one of _only, _values or _keys_only can be used")
+
+    if options["split_shards"]:
+        # Straggling shards use this to split what they have left
+        options["key_ranges_getter"] = key_ranges_getter
+
     defer(
         _generate_shards,
         queryset.model,
@@ -536,6 +1543,25 @@ def defer_iteration_with_finalize(
         delete_marker=_delete_marker,
         key_ranges_getter=key_ranges_getter,
         shards=_shards,
+        options=options,
         _queue=_queue,
         _transactional=_transactional
     )
+
+
+def defer_iteration_with_reduce(
+        queryset, callback, reducer, finalize, initial=None, combiner=None, key_ranges_getter=datastore_key_ranges,
+        _queue='default', _shards=5, _delete_marker=True, _transactional=False, *args, **kwargs):
+    """
+        Like defer_iteration_with_finalize, but `callback` returns (or yields) values
+        which each shard combines into a partial result, starting from `initial`, with
+        `combiner(partial, value)`. `combiner` defaults to `reducer`. Once all shards
+        are complete the partial results are combined with `reducer(partial, partial)`
+        and passed to `finalize` as its first argument.
+    """
+    kwargs["_reduce"] = (combiner or reducer, reducer, initial)
+
+    return defer_iteration_with_finalize(
+        queryset, callback, finalize, key_ranges_getter, _queue, _shards, _delete_marker, _transactional,
+        *args, **kwargs
+    )
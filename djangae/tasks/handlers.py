@@ -1,10 +1,10 @@
 import logging
-import pickle
 
 from django.http import HttpResponse
 from django.views.decorators.csrf import csrf_exempt
 
 from .decorators import task_only
+from .instrumentation import run_task_payload
 from . import environment
 
 logger = logging.getLogger(__name__)
@@ -15,12 +15,14 @@ logger = logging.getLogger(__name__)
 def deferred_handler(request):
     from .deferred import PermanentTaskFailure, SingularTaskFailure
 
-    callback, args, kwargs = pickle.loads(request.body)
-
     logger.debug(f"[DEFERRED] Retry {environment.task_execution_count()} of deferred task")
 
     try:
-        callback(*args, **kwargs)
+        run_task_payload(
+            request.body,
+            queue=environment.task_queue_name(),
+            execution_count=environment.task_execution_count(),
+        )
     except SingularTaskFailure:
         logger.debug("Failure executing task, task retry forced")
         return HttpResponse(status=408)
@@ -0,0 +1,186 @@
+"""
+    Measures the execution of deferred tasks. After each task runs the
+    djangae.tasks.signals.task_executed signal is sent, and the measurements
+    are passed to the callable at settings.DJANGAE_DEFERRED_METRICS_SINK (if set).
+
+    Tasks can also be profiled with cProfile, 1 in every
+    settings.DJANGAE_DEFERRED_PROFILE_SAMPLE_RATE tasks. If
+    settings.DJANGAE_DEFERRED_PROFILE_SLOW_MS is set then only the profiles of
+    sampled tasks slower than that are kept (and if no sample rate is set, 1 in
+    every _DEFAULT_SLOW_PROFILE_SAMPLE_RATE tasks are sampled).
+"""
+
+import cProfile
+import io
+import logging
+import os
+import pstats
+import random
+import time
+import uuid
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+from .signals import task_executed
+
+logger = logging.getLogger(__name__)
+
+_METRICS_SINK_SETTING = "DJANGAE_DEFERRED_METRICS_SINK"
+_PROFILE_SAMPLE_RATE_SETTING = "DJANGAE_DEFERRED_PROFILE_SAMPLE_RATE"
+_PROFILE_SLOW_MS_SETTING = "DJANGAE_DEFERRED_PROFILE_SLOW_MS"
+_PROFILE_DIR_SETTING = "DJANGAE_DEFERRED_PROFILE_DIR"
+
+# Profiling slows a task down, so even when looking for slow tasks only some are profiled
+_DEFAULT_SLOW_PROFILE_SAMPLE_RATE = 100
+
+OUTCOME_SUCCESS = "success"
+OUTCOME_RETRY = "retry"
+OUTCOME_PERMANENT_FAILURE = "permanent_failure"
+OUTCOME_ERROR = "error"
+
+
+class TaskExecution:
+    """
+        Measurements of a single execution of a deferred task. Times are
+        in milliseconds.
+    """
+
+    def __init__(self, body_size, queue, execution_count):
+        self.body_size = body_size
+        self.queue = queue
+        self.execution_count = execution_count
+
+        self.callable_name = None
+        self.unpickle_time = None
+        self.wall_time = None
+        self.cpu_time = None
+        self.outcome = None
+        self.exception = None
+        self.profile = None
+
+    def as_dict(self):
+        return {
+            "body_size": self.body_size,
+            "queue": self.queue,
+            "execution_count": self.execution_count,
+            "callable_name": self.callable_name,
+            "unpickle_time": self.unpickle_time,
+            "wall_time": self.wall_time,
+            "cpu_time": self.cpu_time,
+            "outcome": self.outcome,
+        }
+
+    def __repr__(self):
+        return "<TaskExecution %s %s in %.1fms>" % (self.callable_name, self.outcome, self.wall_time or 0)
+
+
+def _callable_name(callback, args, kwargs=None):
+    from .deferred import _call_with_instances, _run_from_store, invoke_member
+
+    # Look through the wrappers defer() adds
+    if callback is _run_from_store and kwargs and kwargs.get("callable_name"):
+        return kwargs["callable_name"]
+
+    if callback is _call_with_instances and args:
+        callback, args = args[0], args[1:]
+
+    if callback is invoke_member and len(args) >= 2:
+        return "%s.%s" % (type(args[0]).__qualname__, args[1])
+
+    module = getattr(callback, "__module__", None)
+    name = getattr(callback, "__qualname__", None) or type(callback).__qualname__
+    return "%s.%s" % (module, name) if module else name
+
+
+def _should_profile():
+    rate = getattr(settings, _PROFILE_SAMPLE_RATE_SETTING, None)
+    if rate is None and getattr(settings, _PROFILE_SLOW_MS_SETTING, None) is not None:
+        rate = _DEFAULT_SLOW_PROFILE_SAMPLE_RATE
+
+    return bool(rate) and random.randrange(rate) == 0
+
+
+def _save_profile(execution, profiler):
+    slow_ms = getattr(settings, _PROFILE_SLOW_MS_SETTING, None)
+    if slow_ms is not None and execution.wall_time < slow_ms:
+        return
+
+    directory = getattr(settings, _PROFILE_DIR_SETTING, None)
+    if directory:
+        execution.profile = os.path.join(
+            directory, "%s-%s.prof" % (execution.callable_name, uuid.uuid4().hex)
+        )
+        profiler.dump_stats(execution.profile)
+        logger.info("Profiled deferred task %s, saved to %s", execution.callable_name, execution.profile)
+    else:
+        output = io.StringIO()
+        pstats.Stats(profiler, stream=output).sort_stats("cumulative").print_stats(30)
+        execution.profile = output.getvalue()
+        logger.info("Profiled deferred task %s:\n%s", execution.callable_name, execution.profile)
+
+
+def _report(execution):
+    task_executed.send_robust(sender=__name__, execution=execution)
+
+    sink = getattr(settings, _METRICS_SINK_SETTING, None)
+    if sink:
+        try:
+            import_string(sink)(execution)
+        except Exception:
+            logger.exception("Error sending deferred task metrics")
+
+
+def run_task_payload(payload, queue=None, execution_count=None):
+    """
+        Deserializes and runs the task payload, recording measurements of
+        the execution. Any exception raised by the task is re-raised.
+    """
+    from .deferred import PermanentTaskFailure, SingularTaskFailure, _deserialize
+
+    execution = TaskExecution(len(payload), queue, execution_count)
+
+    wall_start = time.perf_counter()
+    cpu_start = time.thread_time()
+    profiler = cProfile.Profile() if _should_profile() else None
+
+    try:
+        callback, args, kwargs = _deserialize(payload)
+        execution.unpickle_time = (time.perf_counter() - wall_start) * 1000
+        execution.callable_name = _callable_name(callback, args, kwargs)
+
+        if profiler:
+            profiler.enable()
+        try:
+            result = callback(*args, **kwargs)
+        finally:
+            if profiler:
+                profiler.disable()
+    except SingularTaskFailure as e:
+        execution.outcome = OUTCOME_RETRY
+        execution.exception = e
+        raise
+    except PermanentTaskFailure as e:
+        execution.outcome = OUTCOME_PERMANENT_FAILURE
+        execution.exception = e
+        raise
+    except Exception as e:
+        execution.outcome = OUTCOME_ERROR
+        execution.exception = e
+        raise
+    else:
+        execution.outcome = OUTCOME_SUCCESS
+        return result
+    finally:
+        execution.wall_time = (time.perf_counter() - wall_start) * 1000
+        execution.cpu_time = (time.thread_time() - cpu_start) * 1000
+
+        logger.debug(
+            "[DEFERRED] %s on queue %s: %s in %.1fms (%.1fms CPU)",
+            execution.callable_name, queue, execution.outcome, execution.wall_time, execution.cpu_time
+        )
+
+        if profiler and execution.callable_name:
+            _save_profile(execution, profiler)
+
+        _report(execution)
@@ -3,3 +3,12 @@ from django.db import models
 
 class DeferredTask(models.Model):
     data = models.BinaryField()
+
+    # Set when the payload is deduplicated by its content, see
+    # djangae.tasks.payloads.DatastorePayloadStore
+    content_key = models.CharField(max_length=64, blank=True, default="")
+    created = models.DateTimeField(auto_now_add=True, null=True)
+
+    # The latest time a task using this payload was scheduled to run (or was
+    # retried), payloads are purged when this is old enough
+    last_used = models.DateTimeField(null=True)
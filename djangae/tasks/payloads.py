@@ -0,0 +1,273 @@
+"""
+    Stores for deferred task payloads which are too large to be sent
+    with the task itself.
+
+    The store is configured with settings.DJANGAE_DEFERRED_PAYLOAD_STORE (the
+    import path of a PayloadStore subclass) and settings.DJANGAE_DEFERRED_PAYLOAD_STORE_OPTIONS
+    (a dictionary of keyword arguments to pass to it).
+"""
+
+import hashlib
+import os
+import tempfile
+import uuid
+from datetime import (
+    datetime,
+    timedelta,
+)
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import FileSystemStorage
+from django.utils import timezone
+from django.utils.module_loading import import_string
+from gcloudc.db import transaction
+
+from .models import DeferredTask
+
+_PAYLOAD_STORE_SETTING = "DJANGAE_DEFERRED_PAYLOAD_STORE"
+_PAYLOAD_STORE_OPTIONS_SETTING = "DJANGAE_DEFERRED_PAYLOAD_STORE_OPTIONS"
+_DEFAULT_PAYLOAD_STORE = "djangae.tasks.payloads.DatastorePayloadStore"
+
+# Cloud Storage metadata recording when a payload was last used
+_LAST_USED_METADATA = "djangae-last-used"
+
+
+def _last_used(eta=None):
+    """
+        Returns when a task scheduled for `eta` (or now) will use a payload, which
+        is the earliest time it can be purged (plus max_age)
+    """
+    now = timezone.now()
+    return max(now, eta) if eta else now
+
+
+class PayloadStore:
+    """
+        Base class for payload stores.
+
+        If `dedupe` is True then payloads are stored under a key derived from
+        their content, so identical payloads deferred to many tasks are only
+        stored once. As these payloads may be shared between tasks they are not
+        deleted when a task runs, and should be removed periodically with `purge()`.
+
+        Stores record when each payload was last used: the latest time that a task
+        using it was scheduled to run, or was retried. `purge()` only deletes payloads
+        which haven't been used for `max_age`, so it should be longer than a task may
+        wait between retries.
+
+        Stores are pickled as part of the task which reads the payload, so they
+        should only hold configuration.
+    """
+
+    def __init__(self, dedupe=False):
+        self.dedupe = dedupe
+
+    def make_key(self, data):
+        if self.dedupe:
+            return hashlib.sha256(data).hexdigest()
+        return uuid.uuid4().hex
+
+    def put(self, data, eta=None):
+        """
+            Stores the data for a task which will run at `eta` (or now), and
+            returns a key to retrieve it with
+        """
+        raise NotImplementedError()
+
+    def touch(self, key, eta=None):
+        """ Records that a task will use the payload at `eta` (or now) """
+        raise NotImplementedError()
+
+    def get(self, key):
+        """ Returns the data stored under key, or None if it doesn't exist """
+        raise NotImplementedError()
+
+    def delete(self, key):
+        raise NotImplementedError()
+
+    def release(self, key):
+        """ Called when a task no longer needs its payload """
+        if not self.dedupe:
+            self.delete(key)
+
+    def purge(self, max_age):
+        """ Deletes any payloads which were last used more than `max_age` (a timedelta) ago """
+        raise NotImplementedError()
+
+
+class DatastorePayloadStore(PayloadStore):
+    """
+        Stores payloads in DeferredTask entities, these are limited
+        by the maximum entity size (1MB)
+    """
+
+    def put(self, data, eta=None):
+        if not self.dedupe:
+            return DeferredTask.objects.create(data=data, last_used=_last_used(eta)).pk
+
+        content_key = self.make_key(data)
+        existing = DeferredTask.objects.filter(content_key=content_key).values_list("pk", flat=True).first()
+        if existing:
+            # Another task may be about to use this, so make sure it isn't purged
+            # before the task that we're storing it for runs
+            self.touch(existing, eta)
+            return existing
+
+        return DeferredTask.objects.create(data=data, content_key=content_key, last_used=_last_used(eta)).pk
+
+    def touch(self, key, eta=None):
+        last_used = _last_used(eta)
+
+        @transaction.atomic()
+        def update():
+            entity = DeferredTask.objects.filter(pk=key).first()
+            if entity and (entity.last_used is None or entity.last_used < last_used):
+                entity.last_used = last_used
+                entity.save()
+
+        update()
+
+    def get(self, key):
+        entity = DeferredTask.objects.filter(pk=key).first()
+        return entity.data if entity else None
+
+    def delete(self, key):
+        DeferredTask.objects.filter(pk=key).delete()
+
+    def purge(self, max_age):
+        cutoff = timezone.now() - max_age
+        DeferredTask.objects.filter(last_used__isnull=False, last_used__lt=cutoff).delete()
+
+        # Payloads stored before we recorded when they were used
+        DeferredTask.objects.filter(last_used__isnull=True, created__lt=cutoff).delete()
+
+
+class StoragePayloadStore(PayloadStore):
+    """
+        Base class for stores which use a Django Storage backend, payloads
+        are saved as files named `prefix` + key
+    """
+
+    def __init__(self, prefix="djangae-deferred/", **kwargs):
+        self.prefix = prefix
+        self._storage = None
+        super().__init__(**kwargs)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_storage"] = None
+        return state
+
+    def create_storage(self):
+        raise NotImplementedError()
+
+    @property
+    def storage(self):
+        if self._storage is None:
+            self._storage = self.create_storage()
+        return self._storage
+
+    def put(self, data, eta=None):
+        name = self.prefix + self.make_key(data)
+        if not (self.dedupe and self.storage.exists(name)):
+            name = self.storage.save(name, ContentFile(data))
+
+        key = name[len(self.prefix):]
+        self.touch(key, eta)
+        return key
+
+    def get(self, key):
+        name = self.prefix + key
+        if not self.storage.exists(name):
+            return None
+
+        with self.storage.open(name, "rb") as f:
+            return f.read()
+
+    def delete(self, key):
+        self.storage.delete(self.prefix + key)
+
+
+class FileSystemPayloadStore(StoragePayloadStore):
+    """
+        Stores payloads on the local filesystem, this is only useful when
+        tasks run on the same machine (e.g. local development)
+    """
+
+    def __init__(self, location=None, **kwargs):
+        self.location = location or os.path.join(tempfile.gettempdir(), "djangae")
+        super().__init__(**kwargs)
+
+    def create_storage(self):
+        return FileSystemStorage(location=self.location)
+
+    def touch(self, key, eta=None):
+        # The file's modification time is when it was last used, which may be in the future
+        path = self.storage.path(self.prefix + key)
+        last_used = _last_used(eta).timestamp()
+        if os.path.exists(path) and os.path.getmtime(path) < last_used:
+            os.utime(path, (last_used, last_used))
+
+    def purge(self, max_age):
+        cutoff = timezone.now() - max_age
+        directory = self.prefix.rstrip("/")
+
+        if not self.storage.exists(directory):
+            return
+
+        for filename in self.storage.listdir(directory)[1]:
+            name = "%s/%s" % (directory, filename)
+            if self.storage.get_modified_time(name) < cutoff:
+                self.storage.delete(name)
+
+
+class CloudStoragePayloadStore(StoragePayloadStore):
+    """
+        Stores payloads in Cloud Storage using djangae.storage.CloudStorage. When
+        payloads aren't deduplicated, you may prefer to set a lifecycle rule on the
+        bucket rather than calling purge(), but it must allow for countdowns and retries.
+    """
+
+    def __init__(self, bucket_name=None, **kwargs):
+        self.bucket_name = bucket_name
+        super().__init__(**kwargs)
+
+    def create_storage(self):
+        from djangae.storage import CloudStorage
+        return CloudStorage(bucket_name=self.bucket_name)
+
+    def touch(self, key, eta=None):
+        blob = self.storage.bucket.get_blob(self.prefix + key)
+        if blob is None:
+            return
+
+        last_used = _last_used(eta)
+        if self._blob_last_used(blob) < last_used:
+            blob.metadata = dict(blob.metadata or {}, **{_LAST_USED_METADATA: last_used.isoformat()})
+            blob.patch()
+
+    def _blob_last_used(self, blob):
+        last_used = (blob.metadata or {}).get(_LAST_USED_METADATA)
+        return datetime.fromisoformat(last_used) if last_used else blob.time_created
+
+    def purge(self, max_age):
+        cutoff = timezone.now() - max_age
+        for blob in self.storage.bucket.list_blobs(prefix=self.prefix):
+            if self._blob_last_used(blob) < cutoff:
+                blob.delete()
+
+
+def get_payload_store():
+    store_class = import_string(getattr(settings, _PAYLOAD_STORE_SETTING, _DEFAULT_PAYLOAD_STORE))
+    return store_class(**getattr(settings, _PAYLOAD_STORE_OPTIONS_SETTING, {}))
+
+
+def purge_deferred_payloads(max_age=timedelta(days=7)):
+    """
+        Removes payloads from the configured store which haven't been used (by a task
+        being scheduled to run, or retried) for max_age. This
+        is necessary when using `dedupe`, and also cleans up payloads for tasks which
+        failed to submit. It can be deferred, or called from a cron.
+    """
+    get_payload_store().purge(max_age)
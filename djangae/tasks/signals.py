@@ -0,0 +1,5 @@
+from django.dispatch import Signal
+
+# Sent after every deferred task runs, with an `execution` argument
+# holding a djangae.tasks.instrumentation.TaskExecution
+task_executed = Signal()
@@ -1,5 +1,8 @@
 
-from django.test import LiveServerTestCase
+from django.test import (
+    LiveServerTestCase,
+    override_settings,
+)
 
 from djangae.tasks import (
     cloud_tasks_parent_path,
@@ -7,6 +10,7 @@ from djangae.tasks import (
     ensure_required_queues_exist,
     get_cloud_tasks_client,
 )
+from djangae.tasks.backends import get_task_backend
 from google.api_core.exceptions import GoogleAPIError
 
 
@@ -35,7 +39,14 @@ class TestCaseMixin(LiveServerTestCase):
         during testing. Ensures that required queues
         are created and paused, and manually runs the
         queued tasks in them to check their responses
+
+        If `in_memory_task_queue` is True then deferred tasks
+        are held in memory rather than sent to the Cloud Tasks
+        emulator, and are run directly in the test process.
     """
+
+    in_memory_task_queue = False
+
     def __init__(self, *args, **kwargs):
         self.max_task_retry_count = 100
         super().__init__(*args, **kwargs)
@@ -45,6 +56,18 @@ class TestCaseMixin(LiveServerTestCase):
 
         super().setUp()
 
+        if self.in_memory_task_queue:
+            self._task_backend_override = override_settings(
+                DJANGAE_DEFERRED_BACKEND="djangae.tasks.backends.InMemoryBackend",
+                DJANGAE_DEFERRED_BACKEND_OPTIONS={},
+            )
+            self._task_backend_override.enable()
+            self.addCleanup(self._task_backend_override.disable)
+
+            self.task_backend = get_task_backend()
+            self.task_backend.purge()
+            return
+
         # Find the port we were allocated
         self._server_port = self.live_server_url.rsplit(":")[-1]
 
@@ -73,10 +96,17 @@ class TestCaseMixin(LiveServerTestCase):
         return queues
 
     def flush_task_queues(self, queue_name=None):
+        if self.in_memory_task_queue:
+            self.task_backend.purge(queue_name)
+            return
+
         for queue in self._get_queues(queue_name=queue_name):
             self.task_client.purge_queue(queue.name)
 
     def get_task_count(self, queue_name=None):
+        if self.in_memory_task_queue:
+            return len(self.task_backend.tasks(queue_name))
+
         count = 0
         for queue in self._get_queues(queue_name=queue_name):
             path = queue.name
@@ -93,7 +123,48 @@ class TestCaseMixin(LiveServerTestCase):
             tasks += [x for x in self.task_client.list_tasks(path)]
         return tasks
 
-    def process_task_queues(self, queue_name=None, failure_behaviour=TaskFailedBehaviour.RAISE_ERROR):
+    def _process_in_memory_task_queues(self, queue_name, failure_behaviour, until):
+        tasks = self.task_backend.tasks(queue_name, until=until)
+        task_failure_counts = {}
+
+        while tasks:
+            task = tasks.pop(0)
+
+            status, exception = self.task_backend.run_task(task)
+            if status != 200:
+                if failure_behaviour == TaskFailedBehaviour.RETRY_TASK:
+                    task_failure_counts[task.name] = task_failure_counts.get(task.name, 0) + 1
+
+                    if task_failure_counts[task.name] >= self.max_task_retry_count:
+                        # Make sure we don't get an infinite loop while retrying
+                        raise TaskFailedError(task.name, status, exception)
+
+                    tasks.append(task)  # Add back to the end of the queue
+                    continue
+                elif failure_behaviour == TaskFailedBehaviour.RAISE_ERROR:
+                    raise TaskFailedError(task.name, status, exception)
+                else:
+                    # Do nothing, ignore the failure
+                    self.task_backend.remove(task)
+
+            if not tasks:
+                tasks = self.task_backend.tasks(queue_name, until=until)
+
+    def process_task_queues(self, queue_name=None, failure_behaviour=TaskFailedBehaviour.RAISE_ERROR, until=None):
+        """
+            Runs the tasks in the queues (or just `queue_name`) until they are empty. When
+            using the in-memory task queue tasks are run in order of their ETA, and if `until`
+            (a datetime) is passed only tasks due to run before then are processed.
+        """
+        if self.in_memory_task_queue:
+            return self._process_in_memory_task_queues(queue_name, failure_behaviour, until)
+
+        if until is not None:
+            raise ValueError(
+                "process_task_queues(until=...) requires the in-memory task queue, set "
+                "in_memory_task_queue = True on the test case to use it"
+            )
+
         queue_names = [q.name for q in self._get_queues(queue_name)]
 
         tasks = self._get_all_tasks_for_queues(queue_names)
@@ -0,0 +1,105 @@
+import time
+from datetime import timedelta
+
+from django.test import override_settings
+from django.utils import timezone
+
+from djangae.tasks.backends import (
+    BaseTaskBackend,
+    get_task_backend,
+)
+from djangae.tasks.deferred import (
+    PermanentTaskFailure,
+    SingularTaskFailure,
+    defer,
+)
+from djangae.tasks.environment import task_queue_name
+from djangae.test import TestCase
+
+from .test_deferred import DeferModelC
+
+calls = []
+
+
+def record(value):
+    calls.append((value, task_queue_name()))
+    return value
+
+
+class OptionsBackend(BaseTaskBackend):
+    def __init__(self, **options):
+        self.options = options
+
+
+def fail_once(exception_class):
+    calls.append(exception_class)
+    if len(calls) == 1:
+        raise exception_class()
+
+
+@override_settings(
+    DJANGAE_DEFERRED_BACKEND="djangae.tasks.backends.ThreadPoolBackend",
+    DJANGAE_DEFERRED_BACKEND_OPTIONS={"max_workers": 2, "retry_delay": 0},
+)
+class ThreadPoolBackendTests(TestCase):
+    def setUp(self):
+        super().setUp()
+        calls.clear()
+        self.backend = get_task_backend()
+
+    def test_runs_task(self):
+        defer(record, 1, _queue="another")
+        self.assertTrue(self.backend.wait(timeout=5))
+
+        self.assertEqual(calls, [(1, "another")])
+
+        # Nothing went to Cloud Tasks
+        self.assertNumTasksEquals(0)
+
+    def test_task_can_use_datastore(self):
+        defer(DeferModelC.objects.create, text="test")
+        self.assertTrue(self.backend.wait(timeout=5))
+        self.assertTrue(DeferModelC.objects.filter(text="test").exists())
+
+    def test_countdown(self):
+        defer(record, 1, _countdown=0.5)
+        self.assertEqual(calls, [])
+
+        time.sleep(0.1)
+        self.assertEqual(calls, [])
+
+        self.assertTrue(self.backend.wait(timeout=5))
+        self.assertEqual(len(calls), 1)
+
+    def test_naive_eta(self):
+        # Naive ETAs are UTC, as they are to Cloud Tasks
+        defer(record, 1, _eta=timezone.now().replace(tzinfo=None) + timedelta(seconds=0.5))
+        self.assertEqual(calls, [])
+
+        self.assertTrue(self.backend.wait(timeout=5))
+        self.assertEqual(len(calls), 1)
+
+    def test_singular_task_failure_retried(self):
+        defer(fail_once, SingularTaskFailure)
+        self.assertTrue(self.backend.wait(timeout=5))
+        self.assertEqual(len(calls), 2)
+
+    def test_permanent_task_failure_not_retried(self):
+        defer(fail_once, PermanentTaskFailure)
+        self.assertTrue(self.backend.wait(timeout=5))
+        self.assertEqual(len(calls), 1)
+
+
+class GetTaskBackendTests(TestCase):
+    def test_unhashable_options(self):
+        path = "%s.OptionsBackend" % __name__
+        options = {"queues": ["default", "another"], "routing": {"service": "worker"}}
+
+        with override_settings(DJANGAE_DEFERRED_BACKEND=path, DJANGAE_DEFERRED_BACKEND_OPTIONS=options):
+            backend = get_task_backend()
+            self.assertEqual(backend.options, options)
+            self.assertIs(get_task_backend(), backend)
+
+        options = {"routing": {"service": "worker"}, "queues": ["another"]}
+        with override_settings(DJANGAE_DEFERRED_BACKEND=path, DJANGAE_DEFERRED_BACKEND_OPTIONS=options):
+            self.assertIsNot(get_task_backend(), backend)
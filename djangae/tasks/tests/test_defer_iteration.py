@@ -1,8 +1,24 @@
-from django.db import models
+from django.db import (
+    DatabaseError,
+    models,
+)
+from django.test import override_settings
 from django.utils import timezone
-from djangae.processing import sequential_int_key_ranges
+from djangae.contrib import sleuth
+from djangae.models import (
+    DeferIterationMarker,
+    DeferIterationShard,
+)
+from djangae.processing import (
+    quantile_key_ranges,
+    sequential_int_key_ranges,
+)
 from djangae.tasks.deferred import (
+    _all_shards_complete,
+    _auto_shard_count,
+    _split_shard,
     defer_iteration_with_finalize,
+    defer_iteration_with_reduce,
     get_deferred_shard_index,
 )
 from djangae.test import (
@@ -10,7 +26,10 @@ from djangae.test import (
     TestCase,
 )
 
+import operator
+import threading
 import time
+from collections import Counter
 
 
 _SHARD_COUNT = 5
@@ -69,6 +88,13 @@ def finalize(*args, **kwargs):
     DeferIterationTestModel.objects.all().update(finalized=True)
 
 
+finalize_calls = []
+
+
+def count_finalize(*args, **kwargs):
+    finalize_calls.append(1)
+
+
 def finalize_int(*args, **kwargs):
     DeferIntegerKeyModel.objects.all().update(finalized=True)
 
@@ -83,6 +109,78 @@ def noop(*args, **kwargs):
     pass
 
 
+processed_pks = []
+fail_on_pk = []
+
+
+def record_or_fail(instance):
+    if instance.pk in fail_on_pk:
+        fail_on_pk.remove(instance.pk)
+        raise ValueError("Boom!")
+
+    processed_pks.append(instance.pk)
+
+
+shard_pks = {}
+
+
+def record_shard(instance):
+    shard_pks.setdefault(get_deferred_shard_index(), []).append(instance.pk)
+
+
+received_rows = []
+
+
+def record_row(row):
+    received_rows.append(row)
+
+
+reduced_results = []
+
+
+def count_or_fail(instance):
+    if instance.pk in fail_on_pk:
+        fail_on_pk.remove(instance.pk)
+        raise ValueError("Boom!")
+    return 1
+
+
+def histogram_key(instance):
+    yield instance.pk % 3
+
+
+def count_key(counter, key):
+    counter[key] += 1
+    return counter
+
+
+def record_reduced(value, *args, **kwargs):
+    reduced_results.append((value, args, kwargs))
+
+
+callback_threads = set()
+
+
+def record_thread(instance):
+    assert(get_deferred_shard_index() == 0)
+    callback_threads.add(threading.get_ident())
+    processed_pks.append(instance.pk)
+    time.sleep(0.01)
+
+
+batch_sizes = []
+
+
+def batch_callback(instances):
+    assert(isinstance(instances, list))
+    batch_sizes.append(len(instances))
+
+    for instance in instances:
+        instance.touched = True
+
+    DeferIterationTestModel.objects.bulk_update(instances, ["touched"])
+
+
 class DeferIterationTestCase(TestCase):
     def test_passing_args_and_kwargs(self):
         [DeferIterationTestModel.objects.create() for i in range(25)]
@@ -186,3 +284,413 @@ class DeferIterationTestCase(TestCase):
 
         self.assertEqual(25, DeferIntegerKeyModel.objects.filter(touched=True).count())
         self.assertEqual(25, DeferIntegerKeyModel.objects.filter(finalized=True).count())
+
+    def test_batch_size(self):
+        [DeferIterationTestModel.objects.create() for i in range(25)]
+        batch_sizes.clear()
+
+        defer_iteration_with_finalize(
+            DeferIterationTestModel.objects.all(),
+            batch_callback,
+            finalize,
+            _shards=1,
+            _batch_size=10,
+        )
+
+        self.process_task_queues()
+
+        self.assertEqual(batch_sizes, [10, 10, 5])
+        self.assertEqual(25, DeferIterationTestModel.objects.filter(touched=True).count())
+        self.assertEqual(25, DeferIterationTestModel.objects.filter(finalized=True).count())
+
+    def test_resume_from_checkpoint(self):
+        [DeferIterationTestModel.objects.create(pk=i + 1) for i in range(25)]
+        processed_pks.clear()
+        fail_on_pk[:] = [1, 10, 20]
+
+        defer_iteration_with_finalize(
+            DeferIterationTestModel.objects.all(),
+            record_or_fail,
+            finalize,
+            _shards=1,
+            _checkpoint_interval=5,
+            _delete_marker=False,
+        )
+
+        self.process_task_queues(failure_behaviour=TaskFailedBehaviour.RETRY_TASK)
+
+        # Nothing was processed twice
+        self.assertEqual(processed_pks, list(range(1, 26)))
+        self.assertEqual(25, DeferIterationTestModel.objects.filter(finalized=True).count())
+
+        checkpoint = DeferIterationShard.objects.get()
+        self.assertEqual(checkpoint.last_key, 25)
+
+    def test_split_shards(self):
+        [DeferIntegerKeyModel.objects.create(id=i + 1) for i in range(41)]
+        shard_pks.clear()
+
+        # Shards run one after the other here, so the second shard notices that
+        # the first is finished and splits off the rest of its range
+        defer_iteration_with_finalize(
+            DeferIntegerKeyModel.objects.all(),
+            record_shard,
+            finalize_int,
+            key_ranges_getter=sequential_int_key_ranges,
+            _shards=2,
+            _checkpoint_interval=5,
+            _split_shards=True,
+            _max_shards=3,
+            _delete_marker=False,
+        )
+
+        self.process_task_queues()
+
+        self.assertEqual(shard_pks[0], list(range(1, 21)))
+        self.assertEqual(shard_pks[1], list(range(21, 34)))
+        self.assertEqual(shard_pks[2], list(range(34, 42)))
+        self.assertEqual(41, DeferIntegerKeyModel.objects.filter(finalized=True).count())
+
+        marker = DeferIterationMarker.objects.get()
+        self.assertEqual(marker.shard_count, 3)
+        self.assertEqual(marker.shards_complete, 3)
+        self.assertEqual(DeferIterationShard.objects.get(shard_number=1).end_key, 34)
+
+    def test_all_shards_complete(self):
+        marker = DeferIterationMarker.objects.create(shard_count=2, is_ready=True)
+        DeferIterationShard.objects.create(
+            pk=DeferIterationShard.make_id(marker.pk, 0), marker_id=marker.pk, shard_number=0, completed=timezone.now()
+        )
+        shard = DeferIterationShard.objects.create(
+            pk=DeferIterationShard.make_id(marker.pk, 1), marker_id=marker.pk, shard_number=1
+        )
+
+        self.assertFalse(_all_shards_complete(marker.pk))
+
+        shard.completed = timezone.now()
+        shard.save()
+        self.assertTrue(_all_shards_complete(marker.pk))
+
+        # Shard entities are the source of truth, so the marker isn't written
+        marker.refresh_from_db()
+        self.assertEqual(marker.shards_complete, 0)
+
+    def test_all_shards_complete_for_old_iterations(self):
+        # An iteration which started before shards had their own entities, one
+        # of its shards completed before then and another has checkpointed since
+        marker = DeferIterationMarker.objects.create(shard_count=3, shards_complete=1, is_ready=True)
+        DeferIterationShard.objects.create(
+            pk=DeferIterationShard.make_id(marker.pk, 1), marker_id=marker.pk, shard_number=1, completed=timezone.now()
+        )
+
+        self.assertFalse(_all_shards_complete(marker.pk))
+        marker.refresh_from_db()
+        self.assertEqual(marker.shards_complete, 2)
+
+        self.assertTrue(_all_shards_complete(marker.pk))
+
+    def test_failed_split_keeps_end_key(self):
+        [DeferIntegerKeyModel.objects.create(id=i + 1) for i in range(40)]
+
+        marker = DeferIterationMarker.objects.create(shard_count=1, is_ready=True)
+        checkpoint = DeferIterationShard.for_shard(marker.pk, 0)
+        checkpoint.save()
+
+        options = {"key_ranges_getter": sequential_int_key_ranges, "max_shards": 2}
+
+        with sleuth.fake("djangae.utils._yield", None):
+            with sleuth.detonate("djangae.tasks.deferred.defer", DatabaseError):
+                with self.assertRaises(DatabaseError):
+                    _split_shard(
+                        marker, checkpoint, DeferIntegerKeyModel, DeferIntegerKeyModel.objects.all().query,
+                        noop, finalize_int, (), {}, options, "default",
+                    )
+
+        # The shard still has to process everything
+        self.assertIsNone(checkpoint.end_key)
+        marker.refresh_from_db()
+        self.assertEqual(marker.shard_count, 1)
+
+    def test_split_attempted_once_per_task(self):
+        [DeferIntegerKeyModel.objects.create(id=i + 1) for i in range(40)]
+
+        with sleuth.fake("djangae.tasks.deferred._find_split_key", None) as find_split_key:
+            defer_iteration_with_finalize(
+                DeferIntegerKeyModel.objects.all(),
+                noop,
+                finalize_int,
+                key_ranges_getter=sequential_int_key_ranges,
+                _shards=2,
+                _checkpoint_interval=5,
+                _split_shards=True,
+            )
+
+            self.process_task_queues()
+
+        # The second shard checkpoints 4 times after the first shard completes, but
+        # only looks for a split key once
+        self.assertEqual(find_split_key.call_count, 1)
+        self.assertEqual(40, DeferIntegerKeyModel.objects.filter(finalized=True).count())
+
+    def test_progress(self):
+        [DeferIterationTestModel.objects.create() for i in range(25)]
+
+        defer_iteration_with_finalize(
+            DeferIterationTestModel.objects.all(),
+            noop,
+            finalize,
+            _shards=1,
+            _checkpoint_interval=10,
+            _delete_marker=False,
+            _estimate_total=True,
+        )
+
+        self.process_task_queues()
+
+        progress = DeferIterationMarker.objects.get().progress()
+        self.assertTrue(progress["is_finished"])
+        self.assertEqual(progress["processed"], 25)
+        self.assertEqual(progress["estimated_total"], 25)
+        self.assertEqual(progress["eta"], progress["completed"])
+
+        shard, = progress["shards"]
+        self.assertEqual(shard["processed"], 25)
+        self.assertIsNotNone(shard["started"])
+        self.assertIsNotNone(shard["completed"])
+
+    def test_total_not_counted_by_default(self):
+        [DeferIterationTestModel.objects.create() for i in range(5)]
+
+        with sleuth.watch("django.db.models.query.QuerySet.count") as count:
+            defer_iteration_with_finalize(
+                DeferIterationTestModel.objects.all(), noop, finalize, _shards=1, _delete_marker=False
+            )
+            self.assertFalse(count.called)
+
+        self.process_task_queues()
+
+        progress = DeferIterationMarker.objects.get().progress()
+        self.assertEqual(progress["processed"], 5)
+        self.assertIsNone(progress["estimated_total"])
+
+    @override_settings(DJANGAE_DEFER_ITERATION_TARGET_SHARD_SIZE=10)
+    def test_auto_shards(self):
+        [DeferIntegerKeyModel.objects.create(id=i + 1) for i in range(25)]
+
+        defer_iteration_with_finalize(
+            DeferIntegerKeyModel.objects.all(),
+            noop,
+            finalize_int,
+            key_ranges_getter=sequential_int_key_ranges,
+            _shards="auto",
+            _delete_marker=False,
+        )
+
+        self.process_task_queues()
+
+        self.assertEqual(DeferIterationMarker.objects.get().shard_count, 3)
+        self.assertEqual(25, DeferIntegerKeyModel.objects.filter(finalized=True).count())
+
+    @override_settings(
+        DJANGAE_DEFER_ITERATION_TARGET_SHARD_SIZE=2,
+        DJANGAE_DEFER_ITERATION_MAX_SHARDS=8,
+        CLOUD_TASKS_QUEUES=[{"name": "default", "rate_max_concurrent": 5}, {"name": "another"}],
+    )
+    def test_auto_shard_count(self):
+        [DeferIntegerKeyModel.objects.create(id=i + 1) for i in range(25)]
+        queryset = DeferIntegerKeyModel.objects.all()
+
+        # Limited by the queue's concurrency, or the setting
+        self.assertEqual(_auto_shard_count(queryset, "default"), 5)
+        self.assertEqual(_auto_shard_count(queryset, "another"), 8)
+
+        self.assertEqual(_auto_shard_count(queryset.filter(id__lte=3), "another"), 2)
+        self.assertEqual(_auto_shard_count(queryset.none(), "another"), 1)
+
+        # Shards are kept small enough to finish in a task
+        self.assertEqual(_auto_shard_count(queryset, "another", total=6, throughput=0.001), 6)
+
+        # Counting stops at the limit, and anything that big gets the most shards
+        with override_settings(DJANGAE_DEFER_ITERATION_AUTO_COUNT_LIMIT=6):
+            with sleuth.watch("django.db.models.query.QuerySet.count") as count:
+                self.assertEqual(_auto_shard_count(queryset.filter(id__lte=10), "another"), 8)
+
+            self.assertEqual(count.calls[0].args[0].query.high_mark, 6)
+            self.assertEqual(_auto_shard_count(queryset.filter(id__lte=3), "another"), 2)
+
+    def test_shards_dont_write_marker(self):
+        [DeferIntegerKeyModel.objects.create(id=i + 1) for i in range(25)]
+        finalize_calls.clear()
+
+        with sleuth.watch("djangae.models.DeferIterationMarker.save") as marker_save:
+            defer_iteration_with_finalize(
+                DeferIntegerKeyModel.objects.all(),
+                noop,
+                count_finalize,
+                key_ranges_getter=sequential_int_key_ranges,
+                _shards=5,
+                _delete_marker=False,
+            )
+
+            self.process_task_queues()
+
+            # Created, made ready and claimed for the finalize
+            self.assertEqual(marker_save.call_count, 3)
+
+        self.assertEqual(finalize_calls, [1])
+        self.assertEqual(5, DeferIterationShard.objects.filter(completed__isnull=False).count())
+
+        marker = DeferIterationMarker.objects.get()
+        self.assertTrue(marker.finalize_queued)
+        self.assertTrue(marker.is_finished)
+
+    def test_concurrency(self):
+        [DeferIterationTestModel.objects.create(pk=i + 1) for i in range(25)]
+        processed_pks.clear()
+        callback_threads.clear()
+
+        defer_iteration_with_finalize(
+            DeferIterationTestModel.objects.all(),
+            record_thread,
+            finalize,
+            _shards=1,
+            _concurrency=4,
+        )
+
+        self.process_task_queues()
+
+        self.assertEqual(sorted(processed_pks), list(range(1, 26)))
+        self.assertGreater(len(callback_threads), 1)
+        self.assertNotIn(threading.get_ident(), callback_threads)
+        self.assertEqual(25, DeferIterationTestModel.objects.filter(finalized=True).count())
+
+    def test_concurrency_resumes_from_first_unfinished(self):
+        [DeferIterationTestModel.objects.create(pk=i + 1) for i in range(25)]
+        processed_pks.clear()
+        fail_on_pk[:] = [10]
+
+        defer_iteration_with_finalize(
+            DeferIterationTestModel.objects.all(),
+            record_or_fail,
+            finalize,
+            _shards=1,
+            _concurrency=4,
+            _checkpoint_interval=1,
+            _delete_marker=False,
+        )
+
+        self.process_task_queues()
+
+        # Callbacks which were running after the failure may be repeated, but
+        # nothing is skipped and nothing before the failure is repeated
+        self.assertEqual(sorted(set(processed_pks)), list(range(1, 26)))
+        self.assertEqual(len([x for x in processed_pks if x < 10]), 9)
+        self.assertEqual(DeferIterationShard.objects.get().last_key, 25)
+
+    def test_reduce(self):
+        [DeferIntegerKeyModel.objects.create(id=i + 1) for i in range(25)]
+        reduced_results.clear()
+        fail_on_pk[:] = [10]
+
+        defer_iteration_with_reduce(
+            DeferIntegerKeyModel.objects.all(),
+            count_or_fail,
+            operator.add,
+            record_reduced,
+            0,
+            None,
+            sequential_int_key_ranges,
+            "default",
+            4,
+            True,
+            False,
+            "arg",
+            _checkpoint_interval=2,
+            kwarg="kwarg",
+        )
+
+        self.process_task_queues()
+
+        # The failure didn't cause anything to be counted twice
+        self.assertEqual(reduced_results, [(25, ("arg",), {"kwarg": "kwarg"})])
+
+    def test_reduce_with_combiner(self):
+        [DeferIntegerKeyModel.objects.create(id=i + 1) for i in range(25)]
+        reduced_results.clear()
+
+        defer_iteration_with_reduce(
+            DeferIntegerKeyModel.objects.all(),
+            histogram_key,
+            operator.add,
+            record_reduced,
+            initial=Counter(),
+            combiner=count_key,
+            key_ranges_getter=sequential_int_key_ranges,
+            _shards=4,
+        )
+
+        self.process_task_queues()
+
+        self.assertEqual(reduced_results, [(Counter({0: 8, 1: 9, 2: 8}), (), {})])
+
+    def test_keys_only(self):
+        [DeferIterationTestModel.objects.create(pk=i + 1) for i in range(25)]
+        received_rows.clear()
+
+        defer_iteration_with_finalize(
+            DeferIterationTestModel.objects.all(), record_row, finalize, _shards=1, _keys_only=True
+        )
+
+        self.process_task_queues()
+
+        self.assertEqual(received_rows, list(range(1, 26)))
+        self.assertEqual(25, DeferIterationTestModel.objects.filter(finalized=True).count())
+
+    def test_values(self):
+        [DeferIterationTestModel.objects.create(pk=i + 1, ignored=bool(i % 2)) for i in range(25)]
+        received_rows.clear()
+
+        defer_iteration_with_finalize(
+            DeferIterationTestModel.objects.all(), record_row, finalize, _shards=1, _values=["ignored"]
+        )
+
+        self.process_task_queues()
+
+        self.assertEqual([(x.pk, x.ignored) for x in received_rows], [(i + 1, bool(i % 2)) for i in range(25)])
+
+    def test_only(self):
+        [DeferIterationTestModel.objects.create(pk=i + 1) for i in range(25)]
+        received_rows.clear()
+
+        defer_iteration_with_finalize(
+            DeferIterationTestModel.objects.all(), record_row, finalize, _shards=1, _only=["touched"]
+        )
+
+        self.process_task_queues()
+
+        self.assertEqual([x.pk for x in received_rows], list(range(1, 26)))
+        self.assertEqual(received_rows[0].get_deferred_fields(), {"finalized", "ignored"})
+
+        with self.assertRaises(ValueError):
+            defer_iteration_with_finalize(
+                DeferIterationTestModel.objects.all(), record_row, finalize, _only=["touched"], _keys_only=True
+            )
+
+    def test_estimated_shard_populations(self):
+        [DeferIntegerKeyModel.objects.create(id=i + 1) for i in range(25)]
+
+        defer_iteration_with_finalize(
+            DeferIntegerKeyModel.objects.all(),
+            noop,
+            finalize_int,
+            key_ranges_getter=quantile_key_ranges,
+            _shards=4,
+            _delete_marker=False,
+        )
+
+        self.process_task_queues()
+
+        progress = DeferIterationMarker.objects.get().progress()
+        self.assertEqual(progress["estimated_total"], 25)
+        self.assertEqual([x["estimated_count"] for x in progress["shards"]], [6, 6, 6, 7])
+        self.assertEqual([x["processed"] for x in progress["shards"]], [6, 6, 6, 7])
@@ -1,10 +1,26 @@
 import os
+import pickle
 
 from django.db import models
+from django.test import override_settings
 from gcloudc.db import transaction
 
 from djangae.contrib import sleuth
-from djangae.tasks.deferred import defer, PermanentTaskFailure
+from djangae.tasks import (
+    cloud_tasks_client_stats,
+    get_cloud_tasks_client,
+)
+from djangae.tasks.models import DeferredTask
+from djangae.tasks.deferred import (
+    PermanentTaskFailure,
+    _deserialize,
+    _serialize,
+    batch,
+    defer,
+    defer_many,
+    deferred_stats,
+    reset_deferred_stats,
+)
 from djangae.test import (
     TaskFailedError,
     TestCase,
@@ -39,6 +55,12 @@ class DeferModelC(models.Model):
         app_label = "djangae"
 
 
+def assert_caches_wiped(instances):
+    for instance in instances:
+        assert_cache_wiped(instance)
+        assert(not hasattr(instance, "_prefetched_objects_cache"))
+
+
 def create_defer_model_b(key_value):
     DeferModelB.objects.create(pk=key_value)
 
@@ -47,6 +69,12 @@ def process_argument(arg):
     DeferModelC.objects.create(text=arg)
 
 
+def assert_text(instance, text, other=None):
+    assert(instance.text == text)
+    if other:
+        assert(other.text == text)
+
+
 def permanent_task_failure():
     raise PermanentTaskFailure
 
@@ -69,6 +97,29 @@ class DeferTests(TestCase):
         instance = DeferModelC.objects.get()
         self.assertEqual(instance.text, big_string)
 
+    def test_small_task_not_stored(self):
+        reset_deferred_stats()
+
+        with sleuth.watch("djangae.tasks.deferred._spill_payload") as spill:
+            defer(process_argument, "small")
+            self.assertFalse(spill.called)
+
+        self.assertEqual(1, deferred_stats()["inline_tasks"])
+        self.process_task_queues()
+        self.assertEqual(DeferModelC.objects.get().text, "small")
+
+    @override_settings(DJANGAE_DEFERRED_MAX_INLINE_TASK_SIZE=10, DJANGAE_DEFERRED_COMPRESSION=None)
+    def test_task_spilled_over_inline_size(self):
+        reset_deferred_stats()
+
+        defer(process_argument, "not so small")
+        self.assertEqual(1, deferred_stats()["spilled_tasks"])
+        self.assertEqual(1, DeferredTask.objects.count())
+
+        self.process_task_queues()
+        self.assertEqual(DeferModelC.objects.get().text, "not so small")
+        self.assertEqual(0, DeferredTask.objects.count())
+
     def test_wipe_related_caches(self):
         b = DeferModelB.objects.create()
         a = DeferModelA.objects.create(b=b)
@@ -88,6 +139,51 @@ class DeferTests(TestCase):
         # Should not have wiped the cache for us!
         self.assertIsNotNone(getattr(a, cache_name, None))
 
+    def test_wipe_nested_and_prefetch_caches(self):
+        b = DeferModelB.objects.create()
+        a = DeferModelA.objects.create(b=b)
+        a.b  # Make sure we access it
+        a._prefetched_objects_cache = {"things": []}
+
+        defer(assert_caches_wiped, [a], _wipe_prefetch_caches=True)
+
+        try:
+            self.process_task_queues()
+        except TaskFailedError as e:
+            raise e.original_exception
+
+        # The instance itself is untouched
+        self.assertTrue(DeferModelA._meta.get_field("b").is_cached(a))
+        self.assertTrue(a._prefetched_objects_cache)
+
+    def test_instances_by_reference(self):
+        c1 = DeferModelC.objects.create(text="before")
+        c2 = DeferModelC.objects.create(text="before")
+
+        with sleuth.watch("djangae.tasks.deferred._dumps") as dumps:
+            defer(assert_text, c1, "after", other=c2, _instances_by_reference=True)
+
+            # No instances are pickled
+            func, args, kwargs = dumps.calls[0].args[0]
+            self.assertFalse(any(isinstance(x, models.Model) for x in args + tuple(kwargs.values())))
+
+        # The instances are reloaded when the task runs
+        DeferModelC.objects.update(text="after")
+
+        try:
+            self.process_task_queues()
+        except TaskFailedError as e:
+            raise e.original_exception
+
+    def test_instances_by_reference_deleted(self):
+        c1 = DeferModelC.objects.create(text="before")
+        defer(assert_text, c1, "before", _instances_by_reference=True)
+        c1.delete()
+
+        # Task fails permanently, so nothing is raised
+        self.process_task_queues()
+        self.assertEqual(self.get_task_count(), 0)
+
     def test_queues_task(self):
         initial_count = self.get_task_count()
         defer(test_task)
@@ -125,6 +221,18 @@ class DeferTests(TestCase):
 
         del os.environ['GAE_VERSION']
 
+    def test_client_is_reused(self):
+        client = get_cloud_tasks_client()
+        reuses = cloud_tasks_client_stats()["reuses"]
+        creations = cloud_tasks_client_stats()["creations"]
+
+        defer(test_task)
+        defer(test_task)
+
+        self.assertIs(client, get_cloud_tasks_client())
+        self.assertEqual(creations, cloud_tasks_client_stats()["creations"])
+        self.assertEqual(reuses + 3, cloud_tasks_client_stats()["reuses"])
+
     def test_deprecated_target_parameter(self):
         self.assertRaises(UserWarning, defer, test_task, _target='test')
 
@@ -157,3 +265,123 @@ class DeferTests(TestCase):
         # Complete task without exception raised externally.
         self.process_task_queues()
         self.assertEqual(self.get_task_count(), 0)
+
+
+class DeferBatchTests(TestCase):
+    def test_defer_many(self):
+        initial_count = self.get_task_count()
+
+        results = defer_many([
+            (create_defer_model_b, (i + 1,)) for i in range(10)
+        ] + [(test_task, (), {"_queue": "another"})])
+
+        self.assertEqual(11, len(results))
+        self.assertTrue(all(x.succeeded for x in results))
+        self.assertEqual(self.get_task_count(), initial_count + 11)
+        self.assertNumTasksEquals(1, queue_name="another")
+
+        self.process_task_queues()
+        self.assertEqual(10, DeferModelB.objects.count())
+
+    def test_batch_submits_on_exit(self):
+        with batch() as current:
+            defer(test_task)
+            defer(test_task)
+
+            # Nothing is submitted until the block exits
+            self.assertNumTasksEquals(0)
+
+        self.assertEqual(2, len(current.results))
+        self.assertNumTasksEquals(2)
+
+    def test_batch_not_submitted_on_error(self):
+        try:
+            with batch():
+                defer(test_task)
+                raise ValueError()
+        except ValueError:
+            pass
+
+        self.assertNumTasksEquals(0)
+
+    def test_transactional_batch(self):
+        try:
+            with batch():
+                with transaction.atomic():
+                    defer(create_defer_model_b, 1, _transactional=True)
+                    raise ValueError()  # Rollback the transaction
+        except ValueError:
+            pass
+
+        self.assertNumTasksEquals(0)
+
+        with transaction.atomic():
+            with batch() as current:
+                defer(create_defer_model_b, 1, _transactional=True)
+                defer(create_defer_model_b, 2, _transactional=True)
+
+            # Still in the transaction, so nothing has been submitted
+            self.assertEqual(0, len(current.results))
+            self.assertNumTasksEquals(0)
+
+        self.assertEqual(2, len(current.results))
+        self.process_task_queues()
+        self.assertEqual(2, DeferModelB.objects.count())
+
+    def test_batch_leaves_caller_connections_open(self):
+        with sleuth.watch("django.db.connections.close_all") as close_all:
+            with transaction.atomic():
+                with batch():
+                    defer(create_defer_model_b, 1, _transactional=False)
+
+                # Only one task, so it was submitted on this thread
+                self.assertFalse(close_all.called)
+                DeferModelB.objects.create(pk=2)
+
+            with batch():
+                defer(test_task)
+                defer(test_task)
+
+            # Each worker thread closes its own connections
+            self.assertEqual(close_all.call_count, 2)
+
+        self.process_task_queues()
+        self.assertEqual(2, DeferModelB.objects.count())
+
+
+class PayloadEnvelopeTests(TestCase):
+    def test_small_payload_not_compressed(self):
+        payload = _serialize(test_task, "small")
+        self.assertEqual(payload[3], 1)  # Version
+        self.assertEqual(payload[4], 0)  # Not compressed
+        self.assertEqual(_deserialize(payload), (test_task, ("small",), {}))
+
+    @override_settings(DJANGAE_DEFERRED_COMPRESSION_THRESHOLD=100)
+    def test_large_payload_compressed(self):
+        reset_deferred_stats()
+
+        arg = "x" * 1000
+        payload = _serialize(test_task, arg)
+        self.assertEqual(payload[4], 1)  # zlib
+        self.assertTrue(len(payload) < 1000)
+        self.assertEqual(_deserialize(payload), (test_task, (arg,), {}))
+
+        stats = deferred_stats()
+        self.assertEqual(stats["compressed_tasks"], 1)
+        self.assertTrue(stats["compression_ratio"] < 1)
+
+    @override_settings(DJANGAE_DEFERRED_COMPRESSION=None, DJANGAE_DEFERRED_COMPRESSION_THRESHOLD=100)
+    def test_compression_disabled(self):
+        payload = _serialize(test_task, "x" * 1000)
+        self.assertEqual(payload[4], 0)
+
+    def test_raw_pickle_payload(self):
+        # Tasks queued before the envelope existed are plain pickles
+        payload = pickle.dumps((test_task, (1,), {}), protocol=pickle.HIGHEST_PROTOCOL)
+        self.assertEqual(_deserialize(payload), (test_task, (1,), {}))
+
+    @override_settings(DJANGAE_DEFERRED_COMPRESSION_THRESHOLD=100)
+    def test_compressed_task_runs(self):
+        defer(process_argument, "x" * 1000)
+        self.process_task_queues()
+        self.assertEqual(DeferModelC.objects.get().text, "x" * 1000)
@@ -0,0 +1,113 @@
+from django.test import override_settings
+
+from djangae.contrib import sleuth
+from djangae.tasks.deferred import (
+    SingularTaskFailure,
+    defer,
+)
+from djangae.tasks.instrumentation import _DEFAULT_SLOW_PROFILE_SAMPLE_RATE
+from djangae.tasks.signals import task_executed
+from djangae.test import (
+    TaskFailedBehaviour,
+    TestCase,
+)
+
+sunk = []
+
+
+def sink(execution):
+    sunk.append(execution)
+
+
+def task(value):
+    return value
+
+
+def retry_task():
+    raise SingularTaskFailure()
+
+
+class InstrumentationTests(TestCase):
+    in_memory_task_queue = True
+
+    def setUp(self):
+        super().setUp()
+        sunk.clear()
+
+        self.executions = []
+
+        def receiver(sender, execution, **kwargs):
+            self.executions.append(execution)
+
+        task_executed.connect(receiver, weak=False, dispatch_uid="test_instrumentation")
+        self.addCleanup(task_executed.disconnect, dispatch_uid="test_instrumentation")
+
+    def test_signal_sent(self):
+        defer(task, "x" * 100, _queue="another")
+        self.process_task_queues()
+
+        self.assertEqual(1, len(self.executions))
+        execution = self.executions[0]
+
+        self.assertEqual(execution.callable_name, "%s.task" % __name__)
+        self.assertEqual(execution.queue, "another")
+        self.assertEqual(execution.outcome, "success")
+        self.assertEqual(execution.execution_count, 0)
+        self.assertTrue(execution.body_size > 100)
+        self.assertIsNotNone(execution.unpickle_time)
+        self.assertIsNotNone(execution.wall_time)
+        self.assertIsNotNone(execution.cpu_time)
+        self.assertIsNone(execution.profile)
+
+    @override_settings(DJANGAE_DEFERRED_MAX_INLINE_TASK_SIZE=10)
+    def test_spilled_task_reported_by_name(self):
+        defer(task, "x" * 100)
+        self.process_task_queues()
+
+        self.assertEqual(self.executions[0].callable_name, "%s.task" % __name__)
+
+    def test_retry_outcome(self):
+        defer(retry_task)
+        self.process_task_queues(failure_behaviour=TaskFailedBehaviour.DO_NOTHING)
+
+        self.assertEqual(self.executions[0].outcome, "retry")
+
+    @override_settings(DJANGAE_DEFERRED_METRICS_SINK="%s.sink" % __name__)
+    def test_metrics_sink(self):
+        defer(task, 1)
+        self.process_task_queues()
+
+        self.assertEqual(sunk, self.executions)
+
+    @override_settings(DJANGAE_DEFERRED_PROFILE_SAMPLE_RATE=1)
+    def test_profile_sampled(self):
+        defer(task, 1)
+        self.process_task_queues()
+
+        self.assertIn("function calls", self.executions[0].profile)
+
+    @override_settings(DJANGAE_DEFERRED_PROFILE_SAMPLE_RATE=1, DJANGAE_DEFERRED_PROFILE_SLOW_MS=60 * 1000)
+    def test_fast_task_not_profiled(self):
+        defer(task, 1)
+        self.process_task_queues()
+
+        self.assertIsNone(self.executions[0].profile)
+
+    @override_settings(DJANGAE_DEFERRED_PROFILE_SAMPLE_RATE=1, DJANGAE_DEFERRED_PROFILE_SLOW_MS=0)
+    def test_slow_task_profiled(self):
+        defer(task, 1)
+        self.process_task_queues()
+
+        self.assertIn("function calls", self.executions[0].profile)
+
+    @override_settings(DJANGAE_DEFERRED_PROFILE_SLOW_MS=0)
+    def test_slow_tasks_sampled(self):
+        # Only the tasks picked by the (default) sample rate are profiled
+        with sleuth.fake("djangae.tasks.instrumentation.random.randrange", 1) as randrange:
+            with sleuth.watch("djangae.tasks.instrumentation.cProfile.Profile") as profile:
+                defer(task, 1)
+                self.process_task_queues()
+
+        self.assertEqual(randrange.calls[0].args, (_DEFAULT_SLOW_PROFILE_SAMPLE_RATE,))
+        self.assertFalse(profile.called)
+        self.assertIsNone(self.executions[0].profile)
@@ -0,0 +1,156 @@
+import os
+import pickle
+import shutil
+import tempfile
+from datetime import (
+    timedelta,
+    timezone as dt_timezone,
+)
+
+from django.test import override_settings
+from django.utils import timezone
+
+from djangae.tasks.deferred import (
+    _run_from_store,
+    _serialize,
+    defer,
+)
+from djangae.tasks.models import DeferredTask
+from djangae.tasks.payloads import (
+    DatastorePayloadStore,
+    FileSystemPayloadStore,
+)
+from djangae.test import TestCase
+
+from .test_deferred import (
+    DeferModelC,
+    process_argument,
+)
+
+
+def fail():
+    raise ValueError()
+
+
+class DatastorePayloadStoreTests(TestCase):
+    def test_put_and_get(self):
+        store = DatastorePayloadStore()
+        key = store.put(b"data")
+        self.assertEqual(store.get(key), b"data")
+
+        store.release(key)
+        self.assertIsNone(store.get(key))
+
+    def test_dedupe(self):
+        store = DatastorePayloadStore(dedupe=True)
+        key = store.put(b"data")
+        self.assertEqual(key, store.put(b"data"))
+        self.assertNotEqual(key, store.put(b"other"))
+        self.assertEqual(2, DeferredTask.objects.count())
+
+        # Shared payloads aren't released when a task runs
+        store.release(key)
+        self.assertEqual(store.get(key), b"data")
+
+        store.purge(timedelta(seconds=-1))
+        self.assertEqual(0, DeferredTask.objects.count())
+
+    def test_purge_keeps_recently_used_payloads(self):
+        store = DatastorePayloadStore(dedupe=True)
+        long_ago = timezone.now() - timedelta(days=30)
+
+        key = store.put(b"data")
+        DeferredTask.objects.filter(pk=key).update(created=long_ago, last_used=long_ago)
+
+        # Reusing the payload for another task keeps it
+        self.assertEqual(key, store.put(b"data"))
+        store.purge(timedelta(days=7))
+        self.assertEqual(store.get(key), b"data")
+
+        # As does a task which won't run for a while
+        other_key = store.put(b"other", eta=timezone.now() + timedelta(days=10))
+        DeferredTask.objects.filter(pk=other_key).update(created=long_ago)
+        store.purge(timedelta(days=7))
+        self.assertEqual(store.get(other_key), b"other")
+
+        DeferredTask.objects.update(last_used=long_ago)
+        store.purge(timedelta(days=7))
+        self.assertEqual(0, DeferredTask.objects.count())
+
+    def test_spilled_task_with_naive_eta(self):
+        eta = timezone.now().replace(tzinfo=None) + timedelta(days=10)
+
+        with override_settings(DJANGAE_DEFERRED_MAX_INLINE_TASK_SIZE=10):
+            defer(process_argument, "not so small", _eta=eta)
+
+        # Naive ETAs are UTC, as they are to Cloud Tasks
+        self.assertEqual(DeferredTask.objects.get().last_used, eta.replace(tzinfo=dt_timezone.utc))
+
+    def test_retried_task_touches_payload(self):
+        store = DatastorePayloadStore(dedupe=True)
+        long_ago = timezone.now() - timedelta(days=30)
+
+        key = store.put(_serialize(fail))
+        DeferredTask.objects.filter(pk=key).update(last_used=long_ago)
+
+        self.assertRaises(ValueError, _run_from_store, store, key)
+        self.assertGreater(DeferredTask.objects.get(pk=key).last_used, long_ago)
+
+
+class FileSystemPayloadStoreTests(TestCase):
+    def setUp(self):
+        super().setUp()
+        self.location = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.location)
+        super().tearDown()
+
+    def test_put_and_get(self):
+        store = FileSystemPayloadStore(location=self.location)
+        key = store.put(b"data")
+        self.assertEqual(store.get(key), b"data")
+
+        # Make sure the store survives being sent with the task
+        store = pickle.loads(pickle.dumps(store))
+        store.release(key)
+        self.assertIsNone(store.get(key))
+
+    def test_dedupe(self):
+        store = FileSystemPayloadStore(location=self.location, dedupe=True)
+        key = store.put(b"data")
+        self.assertEqual(key, store.put(b"data"))
+
+        store.release(key)
+        self.assertEqual(store.get(key), b"data")
+
+        store.purge(timedelta(seconds=-1))
+        self.assertIsNone(store.get(key))
+
+    def test_purge_keeps_recently_used_payloads(self):
+        store = FileSystemPayloadStore(location=self.location, dedupe=True)
+        long_ago = (timezone.now() - timedelta(days=30)).timestamp()
+
+        key = store.put(b"data")
+        path = store.storage.path(store.prefix + key)
+        os.utime(path, (long_ago, long_ago))
+
+        self.assertEqual(key, store.put(b"data"))
+        store.purge(timedelta(days=7))
+        self.assertEqual(store.get(key), b"data")
+
+        os.utime(path, (long_ago, long_ago))
+        store.purge(timedelta(days=7))
+        self.assertIsNone(store.get(key))
+
+    def test_large_task_uses_store(self):
+        with override_settings(
+            DJANGAE_DEFERRED_PAYLOAD_STORE="djangae.tasks.payloads.FileSystemPayloadStore",
+            DJANGAE_DEFERRED_PAYLOAD_STORE_OPTIONS={"location": self.location},
+            DJANGAE_DEFERRED_MAX_INLINE_TASK_SIZE=10,
+        ):
+            defer(process_argument, "not so small")
+            self.process_task_queues()
+
+        self.assertEqual(DeferModelC.objects.get().text, "not so small")
+        self.assertEqual(0, DeferredTask.objects.count())
@@ -1,4 +1,8 @@
+from datetime import timedelta
 from unittest.mock import patch
+
+from django.utils import timezone
+
 from djangae.tasks import deferred
 from djangae.test import TestCase, TaskFailedBehaviour, TaskFailedError, CloudStorageTestCaseMixin
 
@@ -52,6 +56,96 @@ class TaskQueueTests(TestCase):
         )
         self.assertEqual(throw_once.counter, 1)
 
+    def test_until_requires_in_memory_queue(self):
+        with self.assertRaises(ValueError):
+            self.process_task_queues(until=timezone.now())
+
+
+calls = []
+
+
+def record(value):
+    calls.append(value)
+
+
+class InMemoryTaskQueueTests(TestCase):
+    in_memory_task_queue = True
+
+    def setUp(self):
+        super().setUp()
+        calls.clear()
+        throw_once.counter = 0
+
+    def test_get_task_count(self):
+        deferred.defer(my_task)
+        deferred.defer(my_task, _queue='another')
+
+        self.assertNumTasksEquals(2)
+        self.assertNumTasksEquals(1, "default")
+        self.assertNumTasksEquals(1, "another")
+
+        self.flush_task_queues("another")
+        self.assertNumTasksEquals(0, "another")
+        self.assertNumTasksEquals(1)
+
+    def test_purge_forgets_task_names(self):
+        deferred.defer(my_task, _name="named-task")
+        self.flush_task_queues()
+
+        # e.g. a later test deferring the same named task
+        deferred.defer(my_task, _name="named-task")
+        self.assertNumTasksEquals(1)
+
+    def test_process_queue_filter(self):
+        deferred.defer(record, 1)
+        deferred.defer(record, 2, _queue='another')
+
+        self.process_task_queues("another")
+        self.assertEqual(calls, [2])
+        self.assertNumTasksEquals(1)
+
+    def test_eta_order(self):
+        deferred.defer(record, 1, _countdown=60)
+        deferred.defer(record, 2)
+        deferred.defer(record, 3, _eta=timezone.now() + timedelta(seconds=30))
+
+        self.process_task_queues(until=timezone.now() + timedelta(seconds=45))
+        self.assertEqual(calls, [2, 3])
+        self.assertNumTasksEquals(1)
+
+        self.process_task_queues()
+        self.assertEqual(calls, [2, 3, 1])
+
+    def test_naive_eta(self):
+        # Naive ETAs are UTC, as they are to Cloud Tasks
+        now = timezone.now().replace(tzinfo=None)
+        deferred.defer(record, 1, _countdown=60)
+        deferred.defer(record, 2, _eta=now + timedelta(seconds=30))
+
+        self.process_task_queues(until=now + timedelta(seconds=45))
+        self.assertEqual(calls, [2])
+        self.assertNumTasksEquals(1)
+
+    def test_task_queue_processing_control(self):
+        deferred.defer(throw_once)
+        self.process_task_queues(failure_behaviour=TaskFailedBehaviour.RETRY_TASK)
+        self.assertEqual(throw_once.counter, 2)
+
+        throw_once.counter = 0
+        deferred.defer(throw_once)
+
+        with self.assertRaises(TaskFailedError) as context:
+            self.process_task_queues(failure_behaviour=TaskFailedBehaviour.RAISE_ERROR)
+
+        self.assertEqual(throw_once.counter, 1)
+        self.assertEqual(str(context.exception.original_exception), "First call")
+
+        throw_once.counter = 0
+        deferred.defer(throw_once)
+        self.process_task_queues(failure_behaviour=TaskFailedBehaviour.DO_NOTHING)
+        self.assertEqual(throw_once.counter, 1)
+        self.assertNumTasksEquals(0)
+
 
 @patch('djangae.test.wipe_cloud_storage')
 class CloudStorageTestCaseMixinTests(CloudStorageTestCaseMixin, TestCase):
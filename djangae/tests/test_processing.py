@@ -1,7 +1,18 @@
+import time
+import uuid
+
 import sleuth
 from django.db import models
 
-from djangae.processing import sequential_int_key_ranges
+from djangae.processing import (
+    _sample_cache_key,
+    datastore_key_ranges,
+    quantile_key_ranges,
+    sequential_int_key_ranges,
+    sparse_int_key_ranges,
+    string_key_ranges,
+    uuid_key_ranges,
+)
 from djangae.test import TestCase
 
 
@@ -9,6 +20,26 @@ class TestModel(models.Model):
     pass
 
 
+class IntKeyModel(models.Model):
+    id = models.IntegerField(primary_key=True)
+
+
+class StringKeyModel(models.Model):
+    id = models.CharField(primary_key=True, max_length=32)
+
+
+class UUIDKeyModel(models.Model):
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4)
+
+
+random_keys_calls = []
+
+
+def fake_random_keys(queryset, shard_count):
+    random_keys_calls.append(shard_count)
+    return list(range(0, shard_count * 40, 10))
+
+
 class ProcessingTestCase(TestCase):
     def test_sequential_int_key_ranges(self):
         with sleuth.fake("django.db.models.query.QuerySet.first", return_value=0):
@@ -63,3 +94,113 @@ class ProcessingTestCase(TestCase):
                 self.assertEqual(ranges[1], (-999, -998))
                 self.assertEqual(ranges[-1], (999, 1001))
                 self.assertEqual(len(ranges), 2000)
+
+    def test_datastore_key_ranges_cache(self):
+        random_keys_calls.clear()
+        queryset = TestModel.objects.all()
+
+        ranges = datastore_key_ranges(queryset, 4, fake_random_keys, cache_timeout=60)
+        self.assertEqual(ranges, [(None, 40), (40, 80), (80, 120), (120, None)])
+
+        # The sample is reused, including for fewer shards
+        self.assertEqual(datastore_key_ranges(queryset, 4, fake_random_keys, cache_timeout=60), ranges)
+        self.assertEqual(
+            datastore_key_ranges(queryset, 2, fake_random_keys, cache_timeout=60),
+            [(None, 40), (40, None)]
+        )
+        self.assertEqual(random_keys_calls, [4])
+
+        # More shards, or a different filter, needs a new sample
+        datastore_key_ranges(queryset, 8, fake_random_keys, cache_timeout=60)
+        datastore_key_ranges(queryset.filter(pk__gt=5), 4, fake_random_keys, cache_timeout=60)
+        self.assertEqual(random_keys_calls, [4, 8, 4])
+
+        # Without a timeout, nothing is cached
+        datastore_key_ranges(queryset, 4, fake_random_keys)
+        self.assertEqual(random_keys_calls, [4, 8, 4, 4])
+
+    def test_sample_cache_key_includes_database(self):
+        # The same model in another database (e.g. another namespace) has different keys
+        queryset = TestModel.objects.all()
+        self.assertNotEqual(
+            _sample_cache_key(queryset, fake_random_keys),
+            _sample_cache_key(queryset.using("other"), fake_random_keys),
+        )
+
+    def test_datastore_key_ranges_cache_refresh(self):
+        random_keys_calls.clear()
+        queryset = TestModel.objects.all()
+        now = time.time()
+
+        datastore_key_ranges(queryset, 4, fake_random_keys, cache_timeout=60)
+
+        with sleuth.fake("djangae.processing.time.time", return_value=now + 61):
+            datastore_key_ranges(queryset, 2, fake_random_keys, cache_timeout=60)
+            datastore_key_ranges(queryset, 2, fake_random_keys, cache_timeout=60)
+
+        # Refreshed once, at the size of the existing sample
+        self.assertEqual(random_keys_calls, [4, 4])
+
+    def assertShardCounts(self, queryset, ranges, expected=None):
+        counts = []
+        for start, end in ranges:
+            qs = queryset
+            if start is not None:
+                qs = qs.filter(pk__gte=start)
+            if end is not None:
+                qs = qs.filter(pk__lt=end)
+            counts.append(qs.count())
+
+        self.assertEqual(sum(counts), queryset.count())
+        self.assertNotIn(0, counts)
+        if expected:
+            self.assertEqual(counts, expected)
+
+    def test_sparse_int_key_ranges(self):
+        for i in range(50):
+            IntKeyModel.objects.create(id=i + 1)
+            IntKeyModel.objects.create(id=1000000 + i)
+
+        queryset = IntKeyModel.objects.all()
+        self.assertShardCounts(queryset, sparse_int_key_ranges(queryset, 2), [50, 50])
+        self.assertShardCounts(queryset, sparse_int_key_ranges(queryset, 4), [25, 25, 25, 25])
+        self.assertEqual(sparse_int_key_ranges(queryset, 1), [(None, None)])
+        self.assertEqual(sparse_int_key_ranges(queryset.none(), 4), [(None, None)])
+
+    def test_string_key_ranges(self):
+        for i in range(100):
+            StringKeyModel.objects.create(id="user-%s" % uuid.uuid4().hex[:(i % 8) + 4])
+
+        queryset = StringKeyModel.objects.all()
+        ranges = string_key_ranges(queryset, 4)
+        self.assertEqual(len(ranges), 4)
+        self.assertShardCounts(queryset, ranges)
+
+    def test_uuid_key_ranges(self):
+        for i in range(100):
+            UUIDKeyModel.objects.create()
+
+        queryset = UUIDKeyModel.objects.all()
+        ranges = uuid_key_ranges(queryset, 4)
+        self.assertEqual(len(ranges), 4)
+        self.assertIsInstance(ranges[1][0], uuid.UUID)
+        self.assertShardCounts(queryset, ranges)
+
+    def test_quantile_key_ranges(self):
+        for i in range(50):
+            IntKeyModel.objects.create(id=i + 1)
+            IntKeyModel.objects.create(id=1000000 + i)
+
+        queryset = IntKeyModel.objects.all()
+
+        ranges = quantile_key_ranges(queryset, 3)
+        self.assertEqual(ranges, [(None, 34), (34, 1000017), (1000017, None)])
+        self.assertEqual(ranges.populations, [33, 33, 34])
+        self.assertShardCounts(queryset, ranges, ranges.populations)
+
+        ranges = quantile_key_ranges(queryset.filter(pk__lt=10), 20)
+        self.assertEqual(len(ranges), 9)
+        self.assertEqual(ranges.populations, [1] * 9)
+
+        self.assertEqual(quantile_key_ranges(queryset, 1), [(None, None)])
+        self.assertEqual(quantile_key_ranges(queryset.none(), 5).populations, [0])
@@ -1,7 +1,13 @@
 from django.db import models
 from djangae.contrib import sleuth
 from djangae.test import TestCase
-from djangae.utils import get_next_available_port, retry, retry_on_error
+from djangae.utils import (
+    get_in_batches,
+    get_next_available_port,
+    iterate_in_batches,
+    retry,
+    retry_on_error,
+)
 
 
 class AvailablePortTests(TestCase):
@@ -113,3 +119,62 @@ class RetryTestCase(TestCase):
 
         retry(flakey, 1, 2, c=3)
         retry_on_error()(flakey)(1, 2, c=3)
+
+
+class IterateInBatchesTestCase(TestCase):
+    def setUp(self):
+        super().setUp()
+        for i in range(25):
+            EnsureCreatedModel.objects.create(pk=i + 1, field1=25 - i)
+
+    def test_keyset_batches(self):
+        with sleuth.watch("djangae.utils._keyset_batches") as keyset:
+            batches = list(iterate_in_batches(EnsureCreatedModel.objects.all(), batch_size=10))
+            self.assertTrue(keyset.called)
+
+        self.assertEqual([len(x) for x in batches], [10, 10, 5])
+        self.assertEqual([x.pk for batch in batches for x in batch], list(range(1, 26)))
+
+    def test_other_ordering_uses_offsets(self):
+        queryset = EnsureCreatedModel.objects.order_by("field1")
+
+        with sleuth.watch("djangae.utils._keyset_batches") as keyset:
+            results = list(get_in_batches(queryset, batch_size=10))
+            self.assertFalse(keyset.called)
+
+        self.assertEqual([x.field1 for x in results], list(range(1, 26)))
+
+    def test_values_and_slices_use_offsets(self):
+        queryset = EnsureCreatedModel.objects.all()
+
+        with sleuth.watch("djangae.utils._keyset_batches") as keyset:
+            results = list(get_in_batches(queryset.values_list("pk", flat=True), batch_size=10))
+            self.assertEqual(results, list(range(1, 26)))
+
+            results = list(get_in_batches(queryset.values("pk"), batch_size=10))
+            self.assertEqual([x["pk"] for x in results], list(range(1, 26)))
+
+            results = list(get_in_batches(queryset.order_by("pk")[5:20], batch_size=10))
+            self.assertEqual([x.pk for x in results], list(range(6, 21)))
+
+            self.assertFalse(keyset.called)
+
+        # ...unless we're told how to get the key
+        with sleuth.watch("djangae.utils._keyset_batches") as keyset:
+            batches = iterate_in_batches(queryset.values_list("pk", flat=True), batch_size=10, key=lambda x: x)
+            self.assertEqual([x for batch in batches for x in batch], list(range(1, 26)))
+            self.assertTrue(keyset.called)
+
+    def test_prefetch(self):
+        batches = iterate_in_batches(EnsureCreatedModel.objects.all(), batch_size=10, prefetch=2)
+        self.assertEqual([x.pk for batch in batches for x in batch], list(range(1, 26)))
+
+        results = get_in_batches(EnsureCreatedModel.objects.all(), batch_size=3, prefetch=1)
+        self.assertEqual([x.pk for x in results], list(range(1, 26)))
+
+    def test_prefetch_stops_early(self):
+        batches = iterate_in_batches(EnsureCreatedModel.objects.all(), batch_size=5, prefetch=1)
+        self.assertEqual(5, len(next(batches)))
+
+        # Closing the generator stops the background thread
+        batches.close()
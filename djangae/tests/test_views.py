@@ -1,3 +1,4 @@
+from djangae.models import DeferIterationMarker
 from djangae.test import TestCase
 from django.urls import reverse
 
@@ -9,3 +10,20 @@ class ViewsTests(TestCase):
 
         response = self.client.post(reverse("clearsessions"), HTTP_X_APPENGINE_CRON="1")
         self.assertEqual(response.status_code, 200)
+
+    def test_iteration_progress(self):
+        marker = DeferIterationMarker.objects.create(
+            is_ready=True, shard_count=1, estimated_total=10, callback_name="callback", finalize_name="finalize"
+        )
+        url = reverse("iteration_progress", args=(marker.pk,))
+
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 403)
+
+        response = self.client.get(url, HTTP_X_APPENGINE_CRON="1")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["estimated_total"], 10)
+        self.assertEqual(response.json()["processed"], 0)
+
+        response = self.client.get(reverse("iteration_progress", args=(marker.pk + 1,)), HTTP_X_APPENGINE_CRON="1")
+        self.assertEqual(response.status_code, 404)
@@ -7,4 +7,5 @@ urlpatterns = [
     path('stop', views.stop, name="instance_stop"),
     path('warmup', views.warmup, name="instance_warmup"),
     path('clearsessions', views.clearsessions, name="clearsessions"),
+    path('iteration/<int:marker_id>/progress', views.iteration_progress, name="iteration_progress"),
 ]
@@ -79,20 +79,137 @@ def in_testing():
     return "test" in sys.argv
 
 
-def get_in_batches(queryset, batch_size=10):
-    """ prefetches the queryset in batches """
+def _is_ordered_by_pk(queryset):
+    query = queryset.query
+    ordering = query.order_by or (queryset.model._meta.ordering if query.default_ordering else ())
+    pk = queryset.model._meta.pk
+    return not ordering or (len(ordering) == 1 and ordering[0] in ("pk", pk.name, pk.attname))
+
+
+def _can_use_keyset(queryset, key):
+    """
+        Keyset pagination needs to reorder and filter the queryset, and (unless
+        we're given a key function) to read the pk from model instances
+    """
+    from django.db.models.query import ModelIterable
+
+    query = queryset.query
+    if query.low_mark or query.high_mark is not None:
+        return False
+
+    if key is None and not issubclass(queryset._iterable_class, ModelIterable):
+        return False
+
+    return _is_ordered_by_pk(queryset)
+
+
+def _offset_batches(queryset, batch_size):
     start = 0
-    if batch_size < 1:
-        raise Exception("batch_size must be > 0")
-    end = batch_size
     while True:
-        batch = [x for x in queryset[start:end]]
-        for y in batch:
-            yield y
+        batch = list(queryset[start:start + batch_size])
+        if batch:
+            yield batch
         if len(batch) < batch_size:
             break
         start += batch_size
-        end += batch_size
+
+
+def _keyset_batches(queryset, batch_size, key):
+    queryset = queryset.order_by("pk")
+    last_key = None
+    while True:
+        page = queryset if last_key is None else queryset.filter(pk__gt=last_key)
+        batch = list(page[:batch_size])
+        if batch:
+            yield batch
+        if len(batch) < batch_size:
+            break
+        last_key = key(batch[-1])
+
+
+def _read_ahead(iterable, depth):
+    """
+        Iterates `iterable` on a background thread, keeping up to `depth`
+        items ready in a queue for the caller
+    """
+    import queue
+    import threading
+
+    from django.db import connections
+
+    items = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+    done = object()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put((item, None)):
+                    return
+            put((done, None))
+        except BaseException as e:
+            put((None, e))
+        finally:
+            # This thread has its own database connections
+            connections.close_all()
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+
+    try:
+        while True:
+            item, error = items.get()
+            if error:
+                raise error
+            if item is done:
+                break
+            yield item
+    finally:
+        stop.set()
+        thread.join()
+
+
+def iterate_in_batches(queryset, batch_size=100, prefetch=0, key=None):
+    """
+        Yields lists of up to `batch_size` results from the queryset.
+
+        If the queryset is ordered by pk (or not ordered) and isn't sliced then it is
+        paginated by filtering on the last key of the previous batch rather than with
+        offsets, which would get slower with each batch. `key` is a callable returning the
+        pk of a result. Without one, this only applies to querysets of model instances
+        (where the key is `result.pk`), and values() querysets use offsets.
+
+        If `prefetch` is greater than zero, then batches are fetched on a background
+        thread, which keeps up to that many batches ready while the caller is working.
+    """
+    if batch_size < 1:
+        raise Exception("batch_size must be > 0")
+
+    if _can_use_keyset(queryset, key):
+        batches = _keyset_batches(queryset, batch_size, key or (lambda x: x.pk))
+    else:
+        batches = _offset_batches(queryset, batch_size)
+
+    if prefetch > 0:
+        batches = _read_ahead(batches, prefetch)
+
+    return batches
+
+
+def get_in_batches(queryset, batch_size=10, prefetch=0):
+    """ prefetches the queryset in batches """
+    for batch in iterate_in_batches(queryset, batch_size=batch_size, prefetch=prefetch):
+        for y in batch:
+            yield y
 
 
 def retry_until_successful(func, *args, **kwargs):
@@ -2,7 +2,13 @@ import logging
 from importlib import import_module
 
 from django.conf import settings
-from django.http import HttpResponse
+from django.http import (
+    HttpResponse,
+    JsonResponse,
+)
+from django.shortcuts import get_object_or_404
+
+from djangae.models import DeferIterationMarker
 
 from djangae.tasks import decorators
 from djangae.core.signals import module_started, module_stopped
@@ -49,3 +55,12 @@ def clearsessions(request):
             "expired sessions.\n", settings.SESSION_ENGINE
         )
     return HttpResponse("OK")
+
+
+@decorators.task_or_superuser_only
+def iteration_progress(request, marker_id):
+    """
+        Returns the progress of a `defer_iteration_with_finalize` as JSON
+    """
+    marker = get_object_or_404(DeferIterationMarker, pk=marker_id)
+    return JsonResponse(marker.progress())